@@ -16,10 +16,11 @@ Module containing BigQuery code for this program.
 """
 
 import logging
+from threading import Lock
 
 from google.cloud import bigquery
 
-from gcs_inventory_loader.config import get_config
+from gcs_inventory_loader.config import get_bq_config
 
 LOG = logging.getLogger(__name__)
 
@@ -31,20 +32,21 @@ class SingleBQClient():
 
     def __init__(self):
         self.client = None
+        self.lock = Lock()
 
     def get_client(self) -> bigquery.client:
-        """Get a client.
+        """Get a client. The client is made once, on first use; after that,
+        no lock is taken. Threadsafe.
 
         Returns:
             storage.client -- A configured BQ client.
         """
         if not self.client:
-            LOG.debug("Making new BQ client.")
-            config = get_config()
-            self.client = bigquery.Client(
-                project=config.get('BIGQUERY',
-                                   'JOB_PROJECT',
-                                   fallback=config.get('GCP', 'PROJECT')))
+            with self.lock:
+                if not self.client:
+                    LOG.debug("Making new BQ client.")
+                    self.client = bigquery.Client(
+                        project=get_bq_config().job_project)
         return self.client
 
 
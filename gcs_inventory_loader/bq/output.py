@@ -15,88 +15,304 @@
 Module containing BigQuery code for this program.
 """
 
-import json
 import logging
 
-from threading import Lock
-from typing import Iterable
+from gzip import GzipFile
+from tempfile import SpooledTemporaryFile
+from queue import Queue
+from threading import Lock, Thread, current_thread, local
+from time import sleep
+from typing import Iterable, Tuple, Union
 
-from google.api_core.exceptions import BadRequest
+from google.api_core.exceptions import (BadRequest, GoogleAPICallError,
+                                        TooManyRequests)
+from google.cloud.bigquery import (LoadJobConfig, SourceFormat,
+                                   WriteDisposition)
 
 from gcs_inventory_loader.bq.client import get_bq_client
 from gcs_inventory_loader.bq.tables import Table
-from gcs_inventory_loader.config import get_config
+from gcs_inventory_loader.config import get_bq_config
+from gcs_inventory_loader.utils import json_dumps
 
 LOG = logging.getLogger(__name__)
 
+# BigQuery's hard limit on rows in one streaming insert request.
+MAX_ROWS_PER_REQUEST = 50000
+
+# How many rows to add to the batch size after each accepted insert.
+BATCH_SIZE_INCREMENT = 32
+
+# How many times to retry an insert which BigQuery rate limits, and how long
+# to wait before the first retry, in seconds. The wait doubles each time.
+RATE_LIMIT_RETRIES = 5
+RATE_LIMIT_BACKOFF = 1
+
+
+class RowBuffer():
+    """
+    A buffer of rows belonging to a single producer thread.
+    """
+
+    def __init__(self):
+        self.thread = current_thread()
+        self.lock = Lock()
+        self.rows = list()
+        self.size = 0
+
+    def swap(self) -> Tuple[list, int]:
+        """Empty the buffer. The caller must hold the lock.
+
+        Returns:
+            Tuple[list, int] -- The buffered rows and their size in bytes.
+        """
+        batch = (self.rows, self.size)
+        self.rows = list()
+        self.size = 0
+        return batch
+
 
 class BigQueryOutput():
     """
     A queue-like output stream to a BigQuery table.
+
+    Each producer thread buffers rows in its own RowBuffer. Full buffers are
+    handed to a single worker thread, which streams them into BigQuery. At
+    most MAX_PENDING_BATCHES full buffers wait for the worker; past that,
+    producers block until it catches up, which bounds memory use.
+
+    The batch size starts at BATCH_WRITE_SIZE. It grows a little after each
+    batch accepted on its first attempt, and is halved whenever BigQuery
+    rejects a request as too large. A rejected size is never grown into
+    again, so the batch size settles just below the smallest batch BigQuery
+    has rejected. Rate limited inserts are retried after a backoff, without
+    changing the batch size.
     """
 
     def __init__(self, table: Table, create_table: bool = True):
-        self.config = get_config()
+        bq_config = get_bq_config()
         self.lock = Lock()
-        self.rows = list()
+        self.local = local()
+        self.buffers = list()
+        self.queue = Queue(bq_config.max_pending_batches)
+        self.worker = None
+        self.error = None
+        self.client = get_bq_client()
         self.tablename = table.get_fully_qualified_name()
-        self.batch_size = int(
-            self.config.get('BIGQUERY', 'BATCH_WRITE_SIZE', fallback=100))
+        self.batch_size = bq_config.batch_write_size
+        self.dynamic_batch_size = self.batch_size
+        self.batch_size_ceiling = MAX_ROWS_PER_REQUEST
+        self.max_bytes = bq_config.max_write_bytes
         self.insert_count = 0
         self.insert_bytes = 0
         if create_table:
             table.initialize()
 
+    def _get_buffer(self) -> RowBuffer:
+        """Get the calling thread's buffer, registering a new one if needed.
+        Buffers stay registered after their thread exits, until flush()
+        drains them.
+
+        Returns:
+            RowBuffer -- The calling thread's buffer.
+        """
+        buffer = getattr(self.local, "buffer", None)
+        if buffer is None:
+            buffer = RowBuffer()
+            self.local.buffer = buffer
+            with self.lock:
+                self.buffers.append(buffer)
+        return buffer
+
     def put(self, row) -> None:
         """
-        Enqueue a message for streaming to BigQuery. Function usually places
-        the row in memory, but may block until the current buffer of rows is
-        transmitted.
+        Enqueue a message for streaming to BigQuery. Function places the row
+        in the calling thread's buffer, handing the buffer to the worker
+        thread when it is full.
 
-        Raises:
-            error: Errors raised by bigquery.client.insert_rows_json
+        Arguments:
+            row {dict} -- A dictionary representing row data.
+
+        Returns:
+            None
+        """
+        self.put_many((row, ))
+
+    def put_many(self, rows: Iterable) -> None:
+        """
+        Enqueue several messages for streaming to BigQuery, taking the
+        calling thread's buffer lock only once.
 
         Arguments:
-            row {string} -- A JSON string representing row data.
+            rows {Iterable} -- Dictionaries representing row data.
 
         Returns:
             None
         """
-        self.rows.append(row)
-        if len(self.rows) >= self.batch_size and self.lock.acquire(False):
-            self.flush()
-            self.lock.release()
+        buffer = self._get_buffer()
+        batches = []
+        with buffer.lock:
+            for row in rows:
+                buffer.rows.append(row)
+                buffer.size += row_size(row)
+                if len(buffer.rows) >= self.dynamic_batch_size \
+                        or buffer.size >= self.max_bytes:
+                    batches.append(buffer.swap())
+        for batch in batches:
+            self._enqueue(batch)
+
+    def _enqueue(self, batch: Tuple[list, int]) -> None:
+        """Hand a batch of rows to the worker thread, starting it if needed.
+        Blocks while the queue of pending batches is full.
+
+        Arguments:
+            batch {Tuple[list, int]} -- Rows and their size in bytes.
+        """
+        with self.lock:
+            if self.worker is None:
+                self.worker = Thread(target=self._drain, daemon=True)
+                self.worker.start()
+        self.queue.put(batch)
+
+    def _drain(self) -> None:
+        """Worker thread loop. Streams batches from the queue into BigQuery
+        until it receives None.
+        """
+        while True:
+            batch = self.queue.get()
+            try:
+                if batch is None:
+                    return
+                self._insert(*batch)
+            except Exception as error:  # pylint: disable=broad-except
+                self.error = error
+            finally:
+                self.queue.task_done()
 
-    def flush(self) -> None:
+    def _insert(self, rows: list, size: int, retry: bool = False) -> None:
         """
-        Flush all enqueued rows to BigQuery.
+        Stream a batch of rows into BigQuery, adjusting the batch size
+        according to whether the request is accepted. If the request is
+        rejected for being too large, the batch is retried in two halves. If
+        it is rate limited, it is retried after a backoff.
+
+        Arguments:
+            rows {list} -- The rows.
+            size {int} -- The size of the rows in bytes.
+
+        Keyword Arguments:
+            retry {bool} -- Whether this is a retry of part of a rejected
+            batch, in which case the batch size is not grown. (default:
+            {False})
 
         Raises:
             error: Errors raised by bigquery.client.insert_rows_json
+        """
+        LOG.debug("Flushing %s rows to %s, %s bytes.", len(rows),
+                  self.tablename, size)
+        try:
+            for attempt in range(RATE_LIMIT_RETRIES + 1):
+                try:
+                    insert_errors = self.client.insert_rows_json(
+                        self.tablename, rows)
+                    break
+                except TooManyRequests as error:
+                    if attempt == RATE_LIMIT_RETRIES:
+                        raise
+                    delay = RATE_LIMIT_BACKOFF * 2**attempt
+                    LOG.warning(
+                        "Insert of %s rows rate limited, retrying in %s "
+                        "seconds. %s", len(rows), delay, error.message)
+                    sleep(delay)
+                    retry = True
+            if insert_errors and LOG.isEnabledFor(logging.ERROR):
+                LOG.error("Insert errors! %s",
+                          [x for x in flatten(insert_errors)])
+        except GoogleAPICallError as error:
+            # Not ClientError: api_core has no subclass for a 413, so it
+            # raises a plain GoogleAPICallError.
+            if len(rows) > 1 and is_rejected_as_too_large(error):
+                self.batch_size_ceiling = min(self.batch_size_ceiling,
+                                              len(rows) - 1)
+                self.dynamic_batch_size = min(self.dynamic_batch_size,
+                                              max(len(rows) // 2, 1))
+                LOG.warning(
+                    "Insert of %s rows rejected, retrying in halves. "
+                    "Batch size is now %s. %s", len(rows),
+                    self.dynamic_batch_size, error.message)
+                half = len(rows) // 2
+                half_size = size * half // len(rows)
+                self._insert(rows[:half], half_size, retry=True)
+                self._insert(rows[half:], size - half_size, retry=True)
+                return
+            self.insert_count += len(rows)
+            self.insert_bytes += size
+            if isinstance(error, BadRequest) and error.message.endswith(
+                    "No rows present in the request."):
+                return
+            LOG.error("Insert error! %s", error.message)
+            raise error
+        if not retry:
+            self.dynamic_batch_size = min(
+                self.dynamic_batch_size + BATCH_SIZE_INCREMENT,
+                self.batch_size_ceiling)
+        self.insert_count += len(rows)
+        self.insert_bytes += size
+
+    def flush(self, wait: bool = True) -> None:
+        """
+        Flush all enqueued rows from every thread's buffer to BigQuery.
+
+        Keyword Arguments:
+            wait {bool} -- Whether to wait for the rows to be sent. If False,
+            the rows are handed to the worker thread, and any error is
+            raised by a later flush. (default: {True})
+
+        Raises:
+            error: The last error raised by bigquery.client.insert_rows_json
+            since the previous flush.
 
         Returns:
             None
         """
-        if self.rows:
-            if LOG.level <= logging.DEBUG:
-                sending_bytes = sum([len(json.dumps(x)) for x in self.rows])
-                LOG.debug("Flushing %s rows to %s, %s bytes.", len(self.rows),
-                          self.tablename, sending_bytes)
-            client = get_bq_client()
-            try:
-                insert_errors = client.insert_rows_json(
-                    self.tablename, self.rows)
-                if insert_errors:
-                    LOG.error("Insert errors! %s",
-                              [x for x in flatten(insert_errors)])
-            except BadRequest as error:
-                if not error.message.endswith(
-                        "No rows present in the request."):
-                    LOG.error("Insert error! %s", error.message)
-                    raise error
-            finally:
-                self.insert_count += len(self.rows)
-                self.rows = list()
+        with self.lock:
+            buffers = list(self.buffers)
+        drained = set()
+        for buffer in buffers:
+            # A thread which has exited can't add rows after the swap, so
+            # its buffer is done with once drained.
+            if not buffer.thread.is_alive():
+                drained.add(buffer)
+            with buffer.lock:
+                batch = buffer.swap()
+            if batch[0]:
+                self._enqueue(batch)
+        if drained:
+            with self.lock:
+                self.buffers = [x for x in self.buffers if x not in drained]
+        if wait:
+            self.queue.join()
+        error, self.error = self.error, None
+        if error:
+            raise error
+
+    def close(self) -> None:
+        """
+        Flush all enqueued rows to BigQuery and stop the worker thread.
+
+        Raises:
+            error: Errors raised by flush().
+
+        Returns:
+            None
+        """
+        try:
+            self.flush()
+        finally:
+            with self.lock:
+                worker, self.worker = self.worker, None
+            if worker:
+                self.queue.put(None)
+                worker.join()
 
     def stats(self) -> str:
         """
@@ -106,8 +322,237 @@ class BigQueryOutput():
         Returns:
             str -- [description]
         """
+        with self.lock:
+            queued = sum(len(x.rows) for x in self.buffers)
         return "{} rows inserted into {}. {} rows in queue.".format(
-            self.insert_count, self.tablename, len(self.rows))
+            self.insert_count, self.tablename, queued)
+
+
+class BigQueryLoadOutput():
+    """
+    A queue-like output to a BigQuery table which uses load jobs instead of
+    streaming inserts. Rows are staged as gzipped newline-delimited JSON in a
+    temporary file, and the file is loaded into the table whenever it grows
+    past the configured limits, and when the output is closed.
+
+    BigQuery limits how many load jobs may run against a table per day, so
+    flush() does not start a load job; the staged rows are kept until a limit
+    is reached or close() is called.
+    """
+
+    def __init__(self, table: Table, create_table: bool = True):
+        bq_config = get_bq_config()
+        self.lock = Lock()
+        self.client = get_bq_client()
+        self.tablename = table.get_fully_qualified_name()
+        self.max_rows = bq_config.load_job_rows
+        self.max_bytes = bq_config.load_job_bytes
+        self.insert_count = 0
+        self.insert_bytes = 0
+        self._new_buffer()
+        if create_table:
+            table.initialize()
+
+    def _new_buffer(self) -> None:
+        """
+        Start a new staging file. Small files stay in memory; larger ones
+        spill over to disk.
+        """
+        self.buffer = SpooledTemporaryFile(max_size=16 * 1024 * 1024)
+        self.writer = GzipFile(fileobj=self.buffer, mode='wb')
+        self.buffered_rows = 0
+        self.buffered_bytes = 0
+
+    def _swap(self) -> Tuple[SpooledTemporaryFile, GzipFile, int, int]:
+        """
+        Take the staging file and start a new one. The caller must hold the
+        lock.
+
+        Returns:
+            Tuple[SpooledTemporaryFile, GzipFile, int, int] -- The staging
+            file, its writer, and the number and size of the rows in it.
+        """
+        staged = (self.buffer, self.writer, self.buffered_rows,
+                  self.buffered_bytes)
+        self._new_buffer()
+        return staged
+
+    def put(self, row) -> None:
+        """
+        Stage a row for loading into BigQuery. If this row fills the staging
+        file, runs a load job in the calling thread; other threads keep
+        staging rows in a new file meanwhile.
+
+        Raises:
+            error: Errors raised by the load job.
+
+        Arguments:
+            row {dict} -- A dictionary representing row data.
+
+        Returns:
+            None
+        """
+        self.put_many((row, ))
+
+    def put_many(self, rows: Iterable) -> None:
+        """
+        Stage several rows for loading into BigQuery, taking the lock only
+        once. Load jobs for any staging files these rows fill are run after
+        the lock is released.
+
+        Raises:
+            error: Errors raised by the load job.
+
+        Arguments:
+            rows {Iterable} -- Dictionaries representing row data.
+
+        Returns:
+            None
+        """
+        lines = [json_dumps(row) + b"\n" for row in rows]
+        full = []
+        with self.lock:
+            for line in lines:
+                self.writer.write(line)
+                self.buffered_rows += 1
+                self.buffered_bytes += len(line)
+                if self.buffered_rows >= self.max_rows \
+                        or self.buffered_bytes >= self.max_bytes:
+                    full.append(self._swap())
+        for staged in full:
+            self._load(*staged)
+
+    def flush(self, wait: bool = True) -> None:
+        """
+        Provided for parity with BigQueryOutput. Staged rows are kept until a
+        limit is reached or close() is called, so that flushing after each
+        bucket doesn't start a load job per bucket.
+
+        Keyword Arguments:
+            wait {bool} -- Unused. (default: {True})
+
+        Returns:
+            None
+        """
+
+    def close(self) -> None:
+        """
+        Load all staged rows into BigQuery.
+
+        Raises:
+            error: Errors raised by the load job.
+
+        Returns:
+            None
+        """
+        with self.lock:
+            staged = self._swap()
+        self._load(*staged)
+
+    def _load(self, buffer: SpooledTemporaryFile, writer: GzipFile,
+              rows: int, size: int) -> None:
+        """
+        Run a load job for a staging file taken with _swap(), and discard
+        the file. The lock must not be held, so that other threads can keep
+        staging rows while the job runs.
+
+        Arguments:
+            buffer {SpooledTemporaryFile} -- The staging file.
+            writer {GzipFile} -- The writer for the staging file.
+            rows {int} -- The number of rows in the file.
+            size {int} -- The size of the rows in bytes, uncompressed.
+
+        Raises:
+            error: Errors raised by the load job.
+        """
+        try:
+            writer.close()
+            if not rows:
+                return
+            LOG.debug("Loading %s rows into %s, %s bytes.", rows,
+                      self.tablename, size)
+            # The client won't upload a file whose mode isn't binary read,
+            # which a spooled file still in memory reports as 'w+b'.
+            buffer.rollover()
+            buffer.seek(0)
+            job_config = LoadJobConfig(
+                source_format=SourceFormat.NEWLINE_DELIMITED_JSON,
+                write_disposition=WriteDisposition.WRITE_APPEND)
+            job = self.client.load_table_from_file(buffer,
+                                                   self.tablename,
+                                                   job_config=job_config)
+            job.result()
+            with self.lock:
+                self.insert_count += rows
+                self.insert_bytes += size
+        except Exception as error:
+            LOG.error("Load job error! %s", error)
+            raise error
+        finally:
+            buffer.close()
+
+    def stats(self) -> str:
+        """
+        Produce a string describing statistics about this BigQueryLoadOutput,
+        including the number of rows loaded into which table.
+
+        Returns:
+            str -- The statistics.
+        """
+        return "{} rows loaded into {}. {} rows staged.".format(
+            self.insert_count, self.tablename, self.buffered_rows)
+
+
+def get_output(table: Table, create_table: bool = True
+               ) -> Union[BigQueryOutput, BigQueryLoadOutput]:
+    """
+    Get an output for a table, using load jobs if BIGQUERY.USE_LOAD_JOBS is
+    set in the configuration, or streaming inserts otherwise.
+
+    Arguments:
+        table {Table} -- The table to write to.
+
+    Keyword Arguments:
+        create_table {bool} -- Whether to create the table if not found.
+        (default: {True})
+
+    Returns:
+        Union[BigQueryOutput, BigQueryLoadOutput] -- The output.
+    """
+    if get_bq_config().use_load_jobs:
+        return BigQueryLoadOutput(table, create_table)
+    return BigQueryOutput(table, create_table)
+
+
+def row_size(row) -> int:
+    """
+    Measure the size of a row, as sent to BigQuery.
+
+    Arguments:
+        row {dict} -- A dictionary representing row data, or a row already
+        serialized to JSON.
+
+    Returns:
+        int -- The size of the row in bytes.
+    """
+    if isinstance(row, (bytes, str)):
+        return len(row)
+    return len(json_dumps(row))
+
+
+def is_rejected_as_too_large(error: GoogleAPICallError) -> bool:
+    """
+    Check whether a streaming insert was rejected because the request was
+    too large, so that a smaller request may succeed.
+
+    Arguments:
+        error {GoogleAPICallError} -- The error raised by insert_rows_json.
+
+    Returns:
+        bool -- True if a smaller request should be tried.
+    """
+    return error.code == 413 \
+        or "payload size exceeds" in (error.message or "")
 
 
 def flatten(iterable, iter_types=(list, tuple)) -> Iterable:
@@ -126,9 +571,14 @@ def flatten(iterable, iter_types=(list, tuple)) -> Iterable:
         iterable -- A one dimensional iterable with iter_types in the source
         flattened into the top level.
     """
-    for i in iterable:
-        if isinstance(i, iter_types):
-            for j in flatten(i, iter_types):
-                yield j
-        else:
+    # Walk with an explicit stack of iterators rather than recursing, to avoid
+    # a generator frame per level of nesting.
+    stack = [iter(iterable)]
+    while stack:
+        for i in stack[-1]:
+            if isinstance(i, iter_types):
+                stack.append(iter(i))
+                break
             yield i
+        else:
+            stack.pop()
@@ -15,21 +15,32 @@
 Definitions of BigQuery queries used by this program.
 """
 import logging
+from functools import lru_cache
+from typing import Dict, Union
 
+from google.cloud.bigquery import ScalarQueryParameter
 from google.cloud.bigquery.job import QueryJob, QueryJobConfig, WriteDisposition  # noqa: E501
+from google.cloud.bigquery.table import RowIterator
 
 from gcs_inventory_loader.bq.client import get_bq_client
 from gcs_inventory_loader.bq.tables import get_table, TableDefinitions, Table
-from gcs_inventory_loader.config import get_config
+from gcs_inventory_loader.config import (get_bq_config, get_rules,
+                                         register_cache)
 
 LOG = logging.getLogger(__name__)
 
+# BigQuery types for Python values used as query parameters.
+PARAMETER_TYPES = {bool: "BOOL", int: "INT64", float: "FLOAT64", str: "STRING"}
 
-def run_query_job(
-    querytext: str,
-    temp_table: str = None,
-    query_job_config: QueryJobConfig = QueryJobConfig()
-) -> QueryJob:
+# Rows per page when streaming results from a temporary table.
+RESULTS_PAGE_SIZE = 10000
+
+
+def run_query_job(querytext: str,
+                  temp_table: str = None,
+                  query_job_config: QueryJobConfig = None,
+                  params: Dict[str, object] = None
+                  ) -> Union[QueryJob, RowIterator]:
     """
     Set up and run a query job.
 
@@ -38,24 +49,42 @@ def run_query_job(
 
     Keyword Arguments:
         temp_table {str} -- A temporary table in which to materialize results.
-        The results will be streamed from this table when done. This is
-        required for all large queries, and strongly recommended.
-        (default: {None})
+        If given, this waits for the job to finish and returns an iterator
+        which streams the results from this table, RESULTS_PAGE_SIZE rows per
+        page, so they are never all held in memory. This is required for all
+        large queries, and strongly recommended. (default: {None})
 
         query_job_config {QueryJobConfig} -- A QueryJobConfig to start from.
-        (default: {QueryJobConfig()})
+        If not given, a new one is used. (default: {None})
+
+        params {Dict[str, object]} -- Values for named query parameters. Only
+        those referenced in the querytext as @name are sent. (default: {None})
 
     Returns:
-        QueryJob -- The resulting job.
+        Union[QueryJob, RowIterator] -- The resulting job, or if temp_table
+        was given, an iterator over the results.
     """
     LOG.debug("Running query: %s", querytext)
     client = get_bq_client()
+    if query_job_config is None:
+        query_job_config = QueryJobConfig()
+    if params:
+        query_job_config.query_parameters = [
+            ScalarQueryParameter(name, PARAMETER_TYPES[type(value)], value)
+            for name, value in params.items() if "@" + name in querytext
+        ]
     if temp_table:
         query_job_config.destination = temp_table
         query_job_config.write_disposition = WriteDisposition.WRITE_TRUNCATE
-    return client.query(query=querytext, job_config=query_job_config)
+    query_job = client.query(query=querytext, job_config=query_job_config)
+    if temp_table:
+        query_job.result()
+        return client.list_rows(temp_table, page_size=RESULTS_PAGE_SIZE)
+    return query_job
 
 
+@register_cache
+@lru_cache(maxsize=1)
 def _compose_catch_up_union() -> str:
     """
     Compose a UNION ALL statement and secondary query to extend the
@@ -69,8 +98,7 @@ def _compose_catch_up_union() -> str:
     Returns:
         str -- The UNION ALL statement, or empty string.
     """
-    config = get_config()
-    catchup_table_name = config.get("BIGQUERY", "CATCHUP_TABLE", fallback=None)
+    catchup_table_name = get_bq_config().catchup_table
     if catchup_table_name:
         catchup_table = Table(catchup_table_name)
         return """
@@ -91,43 +119,32 @@ def _calculate_day_partitions() -> int:
     Returns:
         int -- The sum of cold threshold days and days between runs.
     """
-    config = get_config()
-    return config.getint('RULES', 'COLD_THRESHOLD_DAYS') + config.getint(
-        'RULES', 'DAYS_BETWEEN_RUNS')
-
-
-def _get_cold_threshold_days() -> int:
-    """Retrieve the warm threshold days from the configuration.
-
-    Returns:
-        int -- Warm threshold days.
-    """
-    config = get_config()
-    return config.getint('RULES', 'COLD_THRESHOLD_DAYS')
+    rules = get_rules()
+    return rules.cold_threshold_days + rules.days_between_runs
 
 
-def _get_warm_threshold_days() -> int:
-    """Retrieve the warm threshold days from the configuration.
+def compose_query_parameters() -> Dict[str, int]:
+    """Compose the query parameters used by the access, warmup and cooldown
+    queries. Thresholds are passed as parameters rather than formatted into
+    the query text, so the text stays the same between runs.
 
     Returns:
-        int -- Warm threshold days.
+        Dict[str, int] -- The parameter values, by name.
     """
-    config = get_config()
-    return config.getint('RULES', 'WARM_THRESHOLD_DAYS')
-
-
-def _get_warm_threshold_accesses() -> int:
-    """Retrieve the warm threshold accesses from the configuration.
-
-    Returns:
-        int -- Warm threshold accesses.
-    """
-    config = get_config()
-    return config.getint('RULES', 'WARM_THRESHOLD_ACCESSES')
+    rules = get_rules()
+    return {
+        "partitions": _calculate_day_partitions(),
+        "warm_days": rules.warm_threshold_days,
+        "warm_accesses": rules.warm_threshold_accesses,
+        "cold_days": rules.cold_threshold_days
+    }
 
 
+@register_cache
+@lru_cache(maxsize=1)
 def compose_access_query() -> str:
-    """Compose the query to get access information for all objects.
+    """Compose the query to get access information for all objects. Run it
+    with the parameters from compose_query_parameters.
 
     Returns:
         str -- The query text.
@@ -136,22 +153,14 @@ def compose_access_query() -> str:
     moved_objects = get_table(TableDefinitions.OBJECTS_MOVED)
     excluded_objects = get_table(TableDefinitions.OBJECTS_EXCLUDED)
 
-    # First, find the most recent move for each object. Then, join the full
-    # move records on that aggregated data to find full move info for the most
-    # recent move.
-    # TODO: Eliminate the JOIN?
+    # Find the most recent move for each object, keeping the full move info.
+    # QUALIFY filters on the window function in a single scan of the table;
+    # BigQuery requires a WHERE, GROUP BY or HAVING alongside it.
     most_recent_moves = """
-        SELECT full_move_info.*
-            FROM `{0}` AS full_move_info
-        INNER JOIN (
-            SELECT
-                resourceName,
-                MAX(moveTimestamp) as timestamp
-            FROM `{0}`
-            GROUP BY resourceName
-        ) AS most_recent
-        ON most_recent.timestamp       = full_move_info.moveTimestamp
-        AND most_recent.resourceName   = full_move_info.resourceName
+        SELECT *
+        FROM `{0}`
+        WHERE TRUE
+        QUALIFY ROW_NUMBER() OVER (PARTITION BY resourceName ORDER BY moveTimestamp DESC) = 1
     """.format(moved_objects.get_fully_qualified_name())
 
     # Perform a bounded query of n days of access logs, possibly with a UNION
@@ -163,11 +172,10 @@ def compose_access_query() -> str:
         timestamp
     FROM `{0}`
     WHERE
-        _TABLE_SUFFIX BETWEEN FORMAT_DATE("%Y%m%d", DATE_SUB(CURRENT_DATE(), INTERVAL {1} DAY))
+        _TABLE_SUFFIX BETWEEN FORMAT_DATE("%Y%m%d", DATE_SUB(CURRENT_DATE(), INTERVAL @partitions DAY))
         AND FORMAT_DATE("%Y%m%d", CURRENT_DATE())
-    {2}
-    """.format(access_log.get_fully_qualified_name(),
-               _calculate_day_partitions(), _compose_catch_up_union())
+    {1}
+    """.format(access_log.get_fully_qualified_name(), _compose_catch_up_union())
 
     # Aggregate the raw access records, in order to calculate most
     # recent access (coldness) as well as the count of accesses within a
@@ -176,14 +184,15 @@ def compose_access_query() -> str:
     SELECT
         resourceName,
         MAX(timestamp) AS lastAccess,
-        COUNTIF(TIMESTAMP_DIFF(CURRENT_TIMESTAMP(), timestamp, DAY) <= {0}) AS recent_access_count
+        COUNTIF(TIMESTAMP_DIFF(CURRENT_TIMESTAMP(), timestamp, DAY) <= @warm_days) AS recent_access_count
     FROM raw_access_records
     GROUP BY resourceName
-    """.format(_get_warm_threshold_days())
+    """
 
     # Final query text. Joins most_recent_moves in order to determine
     # the latest known storage class (avoiding a GET per object to find this
-    # out from GCS), and joins excluded_objects to remove them from the results.
+    # out from GCS), and anti-joins excluded_objects with NOT EXISTS to remove
+    # them from the results. The subquery reads only the resourceName column.
     querytext = """
     WITH most_recent_moves AS ({0}), raw_access_records AS ({1}), aggregated_access_records AS ({2})
 
@@ -196,8 +205,10 @@ def compose_access_query() -> str:
 
     LEFT JOIN most_recent_moves ON access_records.resourceName = most_recent_moves.resourceName
 
-    LEFT JOIN `{3}` as excluded ON access_records.resourceName = excluded.resourceName
-    WHERE excluded.resourceName IS NULL
+    WHERE NOT EXISTS (
+        SELECT 1 FROM `{3}` AS excluded
+        WHERE excluded.resourceName = access_records.resourceName
+    )
     """.format(most_recent_moves, raw_access_records,
                aggregated_access_records,
                excluded_objects.get_fully_qualified_name())
@@ -205,6 +216,8 @@ def compose_access_query() -> str:
     return querytext
 
 
+@register_cache
+@lru_cache(maxsize=1)
 def compose_warmup_query() -> str:
     """
     Compose a query to get only objects that are warm-up candidates.
@@ -214,10 +227,12 @@ def compose_warmup_query() -> str:
     results to focus the work on warmup candidates.
     """
     return compose_access_query() + """
-        AND recent_access_count >= {}
-    """.format(_get_warm_threshold_accesses())
+        AND recent_access_count >= @warm_accesses
+    """
 
 
+@register_cache
+@lru_cache(maxsize=1)
 def compose_cooldown_query() -> str:
     """
     Compose a query to get only objects that are cool-down candidates.
@@ -227,5 +242,5 @@ def compose_cooldown_query() -> str:
     results to focus the work on warmup candidates.
     """
     return compose_access_query() + """
-        AND TIMESTAMP_DIFF(CURRENT_TIMESTAMP(), lastAccess, DAY) >= {}
-    """.format(_get_cold_threshold_days())
+        AND TIMESTAMP_DIFF(CURRENT_TIMESTAMP(), lastAccess, DAY) >= @cold_days
+    """
@@ -17,11 +17,14 @@ Definitions of BigQuery tables used by this program.
 import logging
 
 from enum import Enum
+from functools import lru_cache
+from typing import List
 
 from google.cloud import bigquery
+from google.cloud.bigquery import SchemaField
 
 from gcs_inventory_loader.bq.client import get_bq_client
-from gcs_inventory_loader.config import get_config
+from gcs_inventory_loader.config import get_bq_config, register_cache
 
 LOG = logging.getLogger(__name__)
 
@@ -31,9 +34,14 @@ class Table:
     BigQuery table information and common methods.
     """
 
-    def __init__(self, name: str, schema: str = None):
+    # Tables created or found by initialize() in this process, by fully
+    # qualified name.
+    initialized = dict()
+
+    def __init__(self, name: str, schema: List[SchemaField] = None):
         self.short_name = name
         self.schema = schema
+        self._fqn = None
 
     def drop(self) -> bigquery.table.RowIterator:
         """DROPs (deletes) the table. This cannot be undone.
@@ -57,40 +65,37 @@ class Table:
         LOG.debug("Running query: \n%s", querytext)
 
         query_job = bq_client.query(querytext)
+        Table.initialized.pop(self.get_fully_qualified_name(), None)
         return query_job.result()
 
-    def initialize(self) -> bigquery.table.RowIterator:
-        """Creates, if not found, a table.
+    def initialize(self) -> bigquery.Table:
+        """Creates, if not found, a table. This uses the tables API directly,
+        rather than running a DDL query job. Each table is only created or
+        found once per process; later calls return the cached result.
 
         Returns:
-            google.cloud.bigquery.table.RowIterator -- Result of the query.
-            Since this is a DDL query, this will always be empty if
-            it succeeded.
+            google.cloud.bigquery.Table -- The new or existing table.
 
         Raises:
-            google.cloud.exceptions.GoogleCloudError –- If the job failed.
-            concurrent.futures.TimeoutError –- If the job did not complete
-            in the default BigQuery job timeout.
+            google.cloud.exceptions.GoogleCloudError –- If the request failed.
         """
         if not self.schema:
             raise ValueError(
                 "No schema provided for table {}; writing is not supported.".
                 format(self.short_name))
 
-        bq_client = get_bq_client()
+        fqn = self.get_fully_qualified_name()
+        if fqn in Table.initialized:
+            return Table.initialized[fqn]
 
-        LOG.info("Creating table %s if not found.",
-                 self.get_fully_qualified_name())
+        bq_client = get_bq_client()
 
-        querytext = """
-            CREATE TABLE IF NOT EXISTS `{}` (
-            {}
-            )""".format(self.get_fully_qualified_name(), self.schema)
+        LOG.info("Creating table %s if not found.", fqn)
 
-        LOG.debug("Running query: \n%s", querytext)
-
-        query_job = bq_client.query(querytext)
-        return query_job.result()
+        table = bq_client.create_table(bigquery.Table(fqn, schema=self.schema),
+                                       exists_ok=True)
+        Table.initialized[fqn] = table
+        return table
 
     def get_fully_qualified_name(self) -> str:
         """Return a table name with project and dataset names prefixed.
@@ -101,12 +106,12 @@ class Table:
         Returns:
             str -- Fully qualified name of the table.
         """
-        config = get_config()
-        return "{}.{}.{}".format(
-            config.get("BIGQUERY",
-                       "JOB_PROJECT",
-                       fallback=config.get("GCP", "PROJECT")),
-            config.get("BIGQUERY", "DATASET_NAME"), self.short_name)
+        if self._fqn is None:
+            bq_config = get_bq_config()
+            self._fqn = "{}.{}.{}".format(bq_config.job_project,
+                                          bq_config.dataset_name,
+                                          self.short_name)
+        return self._fqn
 
 
 class TableDefinitions(Enum):
@@ -116,47 +121,88 @@ class TableDefinitions(Enum):
     Where tables have schema = None, they are presumed to be read-only.
     """
     INVENTORY = {
-        "schema":
-        """
-                acl ARRAY<STRUCT<kind STRING, object STRING, generation INT64, id STRING, selfLink STRING, bucket STRING, entity STRING, entityId STRING, role STRING, email STRING, domain STRING, etag STRING, projectTeam STRUCT<projectNumber STRING, team STRING>>>,
-                bucket STRING,
-                cacheControl STRING,
-                componentCount INT64,
-                contentDisposition STRING,
-                contentEncoding STRING,
-                contentLanguage STRING,
-                contentType STRING,
-                crc32c STRING,
-                customerEncryption STRUCT<encryptionAlgorithm STRING, keySha256 STRING>,
-                customTime STRING,
-                etag STRING,
-                eventBasedHold BOOL,
-                generation INT64,
-                id STRING,
-                kind STRING,
-                kmsKeyName STRING,
-                md5Hash STRING,
-                mediaLink STRING,
-                metadata ARRAY<STRUCT<key STRING, value STRING>>,
-                metageneration INT64,
-                name STRING,
-                owner STRUCT<entity STRING, entityId STRING>,
-                retentionExpirationTime TIMESTAMP,
-                selfLink STRING,
-                size INT64,
-                storageClass STRING,
-                temporaryHold BOOL,
-                timeCreated TIMESTAMP,
-                timeDeleted TIMESTAMP,
-                timeStorageClassUpdated TIMESTAMP,
-                updated TIMESTAMP
-            """  # noqa: E501
+        "schema": [
+            SchemaField("acl",
+                        "RECORD",
+                        mode="REPEATED",
+                        fields=[
+                            SchemaField("kind", "STRING"),
+                            SchemaField("object", "STRING"),
+                            SchemaField("generation", "INT64"),
+                            SchemaField("id", "STRING"),
+                            SchemaField("selfLink", "STRING"),
+                            SchemaField("bucket", "STRING"),
+                            SchemaField("entity", "STRING"),
+                            SchemaField("entityId", "STRING"),
+                            SchemaField("role", "STRING"),
+                            SchemaField("email", "STRING"),
+                            SchemaField("domain", "STRING"),
+                            SchemaField("etag", "STRING"),
+                            SchemaField("projectTeam",
+                                        "RECORD",
+                                        fields=[
+                                            SchemaField(
+                                                "projectNumber", "STRING"),
+                                            SchemaField("team", "STRING")
+                                        ])
+                        ]),
+            SchemaField("bucket", "STRING"),
+            SchemaField("cacheControl", "STRING"),
+            SchemaField("componentCount", "INT64"),
+            SchemaField("contentDisposition", "STRING"),
+            SchemaField("contentEncoding", "STRING"),
+            SchemaField("contentLanguage", "STRING"),
+            SchemaField("contentType", "STRING"),
+            SchemaField("crc32c", "STRING"),
+            SchemaField("customerEncryption",
+                        "RECORD",
+                        fields=[
+                            SchemaField("encryptionAlgorithm", "STRING"),
+                            SchemaField("keySha256", "STRING")
+                        ]),
+            SchemaField("customTime", "STRING"),
+            SchemaField("etag", "STRING"),
+            SchemaField("eventBasedHold", "BOOL"),
+            SchemaField("generation", "INT64"),
+            SchemaField("id", "STRING"),
+            SchemaField("kind", "STRING"),
+            SchemaField("kmsKeyName", "STRING"),
+            SchemaField("md5Hash", "STRING"),
+            SchemaField("mediaLink", "STRING"),
+            SchemaField("metadata",
+                        "RECORD",
+                        mode="REPEATED",
+                        fields=[
+                            SchemaField("key", "STRING"),
+                            SchemaField("value", "STRING")
+                        ]),
+            SchemaField("metageneration", "INT64"),
+            SchemaField("name", "STRING"),
+            SchemaField("owner",
+                        "RECORD",
+                        fields=[
+                            SchemaField("entity", "STRING"),
+                            SchemaField("entityId", "STRING")
+                        ]),
+            SchemaField("retentionExpirationTime", "TIMESTAMP"),
+            SchemaField("selfLink", "STRING"),
+            SchemaField("size", "INT64"),
+            SchemaField("storageClass", "STRING"),
+            SchemaField("temporaryHold", "BOOL"),
+            SchemaField("timeCreated", "TIMESTAMP"),
+            SchemaField("timeDeleted", "TIMESTAMP"),
+            SchemaField("timeStorageClassUpdated", "TIMESTAMP"),
+            SchemaField("updated", "TIMESTAMP")
+        ]
     }
 
 
+@register_cache
+@lru_cache(maxsize=None)
 def get_table(table: TableDefinitions, name: str = None) -> Table:
     """    Get a Table object using one of the TableDefinitions enum
-    definitions.
+    definitions. Table objects are cached, so repeated calls return the
+    same object.
 
     Arguments:
         table {TableDefinitions} -- Enum name of the table.
@@ -168,7 +214,7 @@ def get_table(table: TableDefinitions, name: str = None) -> Table:
     Returns:
         Table -- The table object representing the table.
     """
-    kwargs = table.value
+    kwargs = dict(table.value)
     if name:
         kwargs["name"] = name
     return Table(**kwargs)
@@ -28,11 +28,16 @@ def get_bucket_and_object(resource_name: str) -> Tuple[str, str]:
 
     Returns:
         Tuple[str, str] -- Bucket, object name.
-    """
-    pathparts = resource_name.split("buckets/", 1)[1].split("/", 1)
 
-    bucket_name = pathparts[0]
-    object_name = pathparts[1].split("objects/", 1)[1]
+    Raises:
+        ValueError -- If the resourceName doesn't name an object in a bucket.
+    """
+    _, found_bucket, path = resource_name.partition("buckets/")
+    bucket_name, found_slash, path = path.partition("/")
+    _, found_object, object_name = path.partition("objects/")
+    if not (found_bucket and found_slash and found_object):
+        raise ValueError(
+            "Not an object resourceName: {}".format(resource_name))
 
     if object_name.endswith("/"):
         # can happen when catch up table has been populated naively
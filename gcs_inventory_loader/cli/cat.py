@@ -16,18 +16,24 @@ Implementation of "catchup" command.
 """
 
 import logging
-from configparser import ConfigParser
-from time import sleep
+import sys
+from threading import Lock
 from typing import List
 
 from google.cloud.storage import Bucket, Client
 from google.api_core.page_iterator import Page
-from gcs_inventory_loader.config import get_config
+from gcs_inventory_loader.config import RuntimeConfig, get_runtime_config
 from gcs_inventory_loader.gcs.client import get_gcs_client
+from gcs_inventory_loader.gcs.utils import (LIST_PAGE_SIZE, get_buckets,
+                                            listing_options, object_to_row)
 from gcs_inventory_loader.thread import BoundedThreadPoolExecutor
+from gcs_inventory_loader.utils import json_dumps
 
 LOG = logging.getLogger(__name__)
 
+# Page outputters run in many threads; this keeps their pages whole on stdout.
+STDOUT_LOCK = Lock()
+
 
 def cat_command(buckets: List[str] = None, prefix: str = None) -> None:
     """Implementation of the cat command.
@@ -40,23 +46,23 @@ def cat_command(buckets: List[str] = None, prefix: str = None) -> None:
         project-wide bucket listing. (default: {None})
         prefix {str} -- A prefix to use when listing. (default: {None})
     """
-    config = get_config()
+    config = get_runtime_config()
     gcs = get_gcs_client()
 
     # if buckets is given, get each bucket object; otherwise, list all bucket
     # objects
     if buckets:
-        buckets = [gcs.get_bucket(x) for x in buckets]
+        buckets = get_buckets(gcs, buckets)
     else:
-        buckets = [x for x in gcs.list_buckets()]
+        buckets = list(gcs.list_buckets())
 
     total_buckets = len(buckets)
     buckets_listed = 0
     bucket_blob_counts = dict()
 
     # Use at most 2 workers for this part, as it won't be many
-    workers = min(config.getint('RUNTIME', 'WORKERS'), 2)
-    size = int(config.getint('RUNTIME', 'WORK_QUEUE_SIZE') * .25)
+    workers = min(config.workers, 2)
+    size = int(config.work_queue_size * .25)
     with BoundedThreadPoolExecutor(max_workers=workers,
                                    queue_size=size) as executor:
         for bucket in buckets:
@@ -66,17 +72,17 @@ def cat_command(buckets: List[str] = None, prefix: str = None) -> None:
 
     LOG.info("Stats: \n\t%s", bucket_blob_counts)
     LOG.info("Total rows: \n\t%s",
-             sum([v for _, v in bucket_blob_counts.items()]))
+             sum(bucket_blob_counts.values()))
 
 
-def bucket_lister(config: ConfigParser, gcs: Client, bucket: Bucket,
+def bucket_lister(config: RuntimeConfig, gcs: Client, bucket: Bucket,
                   prefix: str, bucket_number: int, total_buckets: int,
                   stats: dict) -> bool:
     """List a bucket, sending each page of the listing into an executor pool
     for processing.
 
     Arguments:
-        config {ConfigParser} -- The program config.
+        config {RuntimeConfig} -- The program runtime config.
         gcs {Client} -- A GCS client object.
         bucket {Bucket} -- A GCS Bucket object to list.
         bucket_number {int} -- The number of this bucket (out of the total).
@@ -87,49 +93,48 @@ def bucket_lister(config: ConfigParser, gcs: Client, bucket: Bucket,
              total_buckets)
     stats[bucket] = 0
 
-    # Check config to determine whether to retrieve ACL for each blob
-    get_acl = config.getboolean("GCP", "ACLS", fallback=False)
-    projection = ''
-    if get_acl is True:
-        projection = 'full'
-    else:
-        projection = 'noAcl'
+    projection, fields = listing_options(config)
 
     # Use remaining configured workers, or at least 2, for this part
-    workers = max(config.getint('RUNTIME', 'WORKERS') - 2, 2)
-    size = int(config.getint('RUNTIME', 'WORK_QUEUE_SIZE') * .75)
+    workers = max(config.workers - 2, 2)
+    size = int(config.work_queue_size * .75)
     with BoundedThreadPoolExecutor(max_workers=workers,
                                    queue_size=size) as sub_executor:
-        blobs = gcs.list_blobs(bucket, prefix=prefix, projection=projection)
+        blobs = gcs.list_blobs(bucket,
+                               prefix=prefix,
+                               projection=projection,
+                               page_size=LIST_PAGE_SIZE,
+                               fields=fields)
         for page in blobs.pages:
             sub_executor.submit(page_outputter, config, bucket, page, stats)
-            sleep(0.02)  # small offset to avoid thundering herd
 
 
-def page_outputter(config: ConfigParser, bucket: Bucket, page: Page,
+def page_outputter(config: RuntimeConfig, bucket: Bucket, page: Page,
                    stats: dict) -> bool:
     """Write a page of blob listing to LDJSON.
 
     Arguments:
-        config {ConfigParser} -- The program config.
+        config {RuntimeConfig} -- The program runtime config.
         bucket {Bucket} -- The bucket where this list page came from.
         page {Page} -- The Page object from the listing.
         stats {dict} -- A dictionary of bucket_name (str): blob_count (int)
     """
     blob_count = 0
+    lines = []
 
     for blob in page:
         blob_count += 1
         # pylint: disable=protected-access
-        blob_metadata = blob._properties
-        if "metadata" in blob_metadata:
-            blob_metadata["metadata"] = [{
-                "key": k,
-                "value": v
-            } for k, v in blob_metadata["metadata"].items()]
-        print(blob_metadata)
+        blob_metadata = object_to_row(blob._properties)
+        lines.append(json_dumps(blob_metadata))
 
     if blob_count:
+        # Write the whole page at once, rather than a write per blob. Lines
+        # are already UTF-8, so they go straight to the binary stream.
+        lines.append(b"")
+        with STDOUT_LOCK:
+            sys.stdout.buffer.write(b"\n".join(lines))
+            sys.stdout.buffer.flush()
         stats[bucket] += blob_count
         LOG.info("%s blob records written for bucket %s.", stats[bucket],
                  bucket.name)
@@ -17,31 +17,47 @@ Implementation of "catchup" command.
 
 import atexit
 from concurrent.futures import TimeoutError
-import json
 import logging
 
 from google.api_core.exceptions import AlreadyExists
+from google.cloud import bigquery
 from google.cloud import pubsub_v1 as pubsub
+from google.cloud.bigquery import (ArrayQueryParameter, QueryJobConfig,
+                                   ScalarQueryParameter,
+                                   ScalarQueryParameterType,
+                                   StructQueryParameter,
+                                   StructQueryParameterType)
 from google.cloud.pubsub_v1.subscriber.message import Message
 from google.cloud.pubsub_v1.subscriber.futures import StreamingPullFuture
 
 from gcs_inventory_loader.bq.output import BigQueryOutput
 from gcs_inventory_loader.bq.tables import TableDefinitions, get_table
-from gcs_inventory_loader.config import get_config
+from gcs_inventory_loader.config import get_bq_config, get_config
 from gcs_inventory_loader.bq.client import get_bq_client
+from gcs_inventory_loader.gcs.utils import object_to_row
+from gcs_inventory_loader.utils import json_loads
 
 LOG = logging.getLogger(__name__)
 
+# Type of the metadata column, as a query parameter. Given explicitly so an
+# empty array can be passed when all metadata is removed.
+METADATA_PARAMETER_TYPE = StructQueryParameterType(
+    ScalarQueryParameterType("STRING", name="key"),
+    ScalarQueryParameterType("STRING", name="value"))
+
+# Object resource fields every event handler relies on.
+REQUIRED_OBJECT_FIELDS = frozenset(("bucket", "name", "id"))
+
 
 def listen_command() -> None:
     """
     Implementation of the listen command.
     """
     config = get_config()
+    table = get_table(TableDefinitions.INVENTORY,
+                      get_bq_config().inventory_table)
     # Call this once to initialize the table.
-    _ = BigQueryOutput(
-        get_table(TableDefinitions.INVENTORY,
-                  config.get("BIGQUERY", "INVENTORY_TABLE")))
+    _ = BigQueryOutput(table)
 
     subscriber = pubsub.SubscriberClient()
     topic_name = 'projects/{}/topics/{}'.format(
@@ -49,7 +65,7 @@ def listen_command() -> None:
     subscription_name = 'projects/{}/subscriptions/{}'.format(
         config.get("GCP", "PROJECT"),
         config.get("PUBSUB", "SUBSCRIPTION_SHORT_NAME"))
-    LOG.info("Creating or adopting subscription {}.".format(subscription_name))
+    LOG.info("Creating or adopting subscription %s.", subscription_name)
     try:
         subscriber.create_subscription(name=subscription_name,
                                        topic=topic_name,
@@ -57,15 +73,17 @@ def listen_command() -> None:
     except AlreadyExists:
         pass
 
-    output = BigQueryOutput(
-        get_table(TableDefinitions.INVENTORY,
-                  config.get("BIGQUERY", "INVENTORY_TABLE")), False)
+    output = BigQueryOutput(table, False)
+    # These don't change, so look them up once rather than per message.
+    bq_client = get_bq_client()
+    table_name = table.get_fully_qualified_name()
 
     def handle(message):
         """Callback for handling new PubSub messages. Effectively, this just
-        "partially applies" the output stream above to unpack_and_insert.
+        "partially applies" the output stream, client and table name above to
+        unpack_and_insert.
         """
-        unpack_and_insert(output, message)
+        unpack_and_insert(output, bq_client, table_name, message)
 
     def shutdown(sub_future: StreamingPullFuture) -> None:
         """Close subscriptions and flush rows to BQ.
@@ -73,7 +91,10 @@ def listen_command() -> None:
         LOG.info("Cancelling subscription pull.")
         sub_future.cancel()
         LOG.info("Flushing rows to BigQuery.")
-        output.flush()
+        try:
+            output.close()
+        except Exception:  # pylint: disable=broad-except
+            LOG.exception("Error flushing rows to BigQuery!")
 
     LOG.info("Subscribing...")
     subscription_future = subscriber.subscribe(subscription_name, handle)
@@ -87,89 +108,165 @@ def listen_command() -> None:
             try:
                 subscription_future.result(timeout=timeout)
             except TimeoutError:
-                LOG.debug("No messages in {} seconds, flushing rows (if any).".
-                          format(timeout))
-                output.flush()
+                LOG.debug("No messages in %s seconds, flushing rows (if any).",
+                          timeout)
+                # Insert errors from earlier batches surface here. Their
+                # messages are already acked, so log them and keep listening.
+                try:
+                    output.flush(wait=False)
+                except Exception:  # pylint: disable=broad-except
+                    LOG.exception("Error flushing rows to BigQuery!")
             except Exception:
                 LOG.info("Quitting...")
                 break
 
 
-def unpack_and_insert(output: BigQueryOutput, message: Message) -> None:
+def unpack_and_insert(output: BigQueryOutput, bq_client: bigquery.Client,
+                      table_name: str, message: Message) -> None:
     """Unpack a PubSub message regarding a GCS object change, and insert it into
     a BigQueryOutput.
 
     Args:
         output (BigQueryOutput): The output to use. In most cases, you will
         want to use a single output object per program.
+        bq_client (bigquery.Client): The client to run update queries with.
+        table_name (str): Fully qualified name of the inventory table.
         message (Message): The PubSub message.
     """
-    bq_client = get_bq_client()
-    config = get_config()
-    table = get_table(TableDefinitions.INVENTORY,
-                      config.get("BIGQUERY", "INVENTORY_TABLE"))
-    table_name = table.get_fully_qualified_name()
-
     try:
-        LOG.debug("Message data: \n---DATA---\n{}\n---DATA---".format(
-            message.data))
+        debug = LOG.isEnabledFor(logging.DEBUG)
+        if debug:
+            LOG.debug("Message data: \n---DATA---\n%s\n---DATA---",
+                      bytes.decode(message.data, "UTF-8"))
 
-        # Decode and deserialize
-        message_string = bytes.decode(message.data, "UTF-8")
-        object_info = json.loads(message_string)
+        # Deserialize straight from the UTF-8 bytes
+        object_info = check_object_info(json_loads(message.data))
 
-        LOG.debug(message)
-        LOG.debug(object_info)
+        if debug:
+            LOG.debug(message)
+            LOG.debug(object_info)
 
         # Get important attributes
         event_type = message.attributes['eventType']
         publish_time = message.publish_time.isoformat()
-        LOG.info("Got a message: {} {} {}".format(
-            publish_time, event_type,
-            object_info['bucket'] + "/" + object_info['name']))
-
-        # For deletes, use the publish time to approximate deleted time
-        if event_type == "OBJECT_DELETE":
-            object_info["timeDeleted"] = publish_time
-            if object_info.get("metadata"):
-                object_info["metadata"] = [{
-                    "key": k,
-                    "value": v
-                } for k, v in object_info["metadata"].items()]
-
-        if event_type == "OBJECT_METADATA_UPDATE":
-
-            def generate_structs(arr):
-                res = '['
-                for s in arr:
-                    res += "STRUCT(\"{key}\" as key, \"{value}\" as value),".format(  # noqa: E501
-                        key=s['key'], value=s['value'])
-                res = res[:-1]
-                res += ']'
-                return res
-
-            querytext = "UPDATE `{table_name}`\
-                SET metadata = {new_metadata}\
-                WHERE id = '{id}'".format(
-                table_name=table_name,
-                new_metadata=generate_structs([{
-                    "key": k,
-                    "value": v
-                } for k, v in object_info["metadata"].items()]),
-                id=object_info["id"])
-            LOG.info("Running query: \n%s", querytext)
-            query_job = bq_client.query(querytext)
-            LOG.info(query_job.result())
-        else:
-            # Enqueue for writing
-            output.put(object_info)
+        if LOG.isEnabledFor(logging.INFO):
+            LOG.info("Got a message: %s %s %s/%s", publish_time, event_type,
+                     object_info['bucket'], object_info['name'])
+
+        handler = EVENT_HANDLERS.get(event_type, handle_change)
+        handler(output, bq_client, table_name, object_info, publish_time)
 
         message.ack()
 
     except Exception:
-        LOG.exception(
-            "Error processing message! ---DATA---\n{}\n---DATA---".format(
-                message.data))
+        LOG.exception("Error processing message! ---DATA---\n%s\n---DATA---",
+                      message.data)
         # TODO: A retry / DLQ policy would be useful, if not already present
         # by default.
         message.nack()
+
+
+def check_object_info(object_info: object) -> dict:
+    """Check that a decoded message is an object resource with the fields
+    the event handlers rely on. All other fields are kept, as they are
+    written to the inventory table.
+
+    Args:
+        object_info (object): The decoded message data.
+
+    Raises:
+        ValueError: If the message is not an object resource.
+
+    Returns:
+        dict: The object resource.
+    """
+    if not isinstance(object_info, dict) \
+            or not REQUIRED_OBJECT_FIELDS.issubset(object_info):
+        raise ValueError("Message is not a GCS object resource.")
+    return object_info
+
+
+def handle_change(output: BigQueryOutput, bq_client: bigquery.Client,
+                  table_name: str, object_info: dict,
+                  publish_time: str) -> None:
+    """Handle an object change event by enqueueing the object for writing.
+    This is the handler for events without one in EVENT_HANDLERS.
+
+    Args:
+        output (BigQueryOutput): The output to use.
+        bq_client (bigquery.Client): Unused.
+        table_name (str): Unused.
+        object_info (dict): The object resource from the message.
+        publish_time (str): When the message was published, in ISO format.
+    """
+    # pylint: disable=unused-argument
+    output.put(object_to_row(object_info))
+
+
+def handle_delete(output: BigQueryOutput, bq_client: bigquery.Client,
+                  table_name: str, object_info: dict,
+                  publish_time: str) -> None:
+    """Handle an OBJECT_DELETE event by enqueueing the object for writing,
+    with the publish time to approximate deleted time.
+
+    Args:
+        output (BigQueryOutput): The output to use.
+        bq_client (bigquery.Client): Unused.
+        table_name (str): Unused.
+        object_info (dict): The object resource from the message.
+        publish_time (str): When the message was published, in ISO format.
+    """
+    # pylint: disable=unused-argument
+    object_info["timeDeleted"] = publish_time
+    output.put(object_to_row(object_info))
+
+
+def handle_metadata_update(output: BigQueryOutput,
+                           bq_client: bigquery.Client, table_name: str,
+                           object_info: dict, publish_time: str) -> None:
+    """Handle an OBJECT_METADATA_UPDATE event by updating the object's
+    metadata in the table.
+
+    Args:
+        output (BigQueryOutput): Unused.
+        bq_client (bigquery.Client): The client to run the update with.
+        table_name (str): Fully qualified name of the inventory table.
+        object_info (dict): The object resource from the message.
+        publish_time (str): Unused.
+    """
+    # pylint: disable=unused-argument
+    # The query text is the same for every update; the new metadata and
+    # object ID are passed as parameters.
+    querytext = ("UPDATE `{}` SET metadata = @metadata "
+                 "WHERE id = @id").format(table_name)
+    job_config = QueryJobConfig(query_parameters=[
+        metadata_parameter(object_info.get("metadata") or {}),
+        ScalarQueryParameter("id", "STRING", object_info["id"])
+    ])
+    LOG.info("Running query: \n%s", querytext)
+    query_job = bq_client.query(querytext, job_config=job_config)
+    LOG.info(query_job.result())
+
+
+# Handlers for event types which need more than handle_change.
+EVENT_HANDLERS = {
+    "OBJECT_DELETE": handle_delete,
+    "OBJECT_METADATA_UPDATE": handle_metadata_update
+}
+
+
+def metadata_parameter(metadata: dict) -> ArrayQueryParameter:
+    """Build a query parameter named "metadata" holding object metadata, in
+    the same ARRAY<STRUCT<key, value>> form as the inventory table.
+
+    Args:
+        metadata (dict): The object's custom metadata.
+
+    Returns:
+        ArrayQueryParameter: The query parameter.
+    """
+    return ArrayQueryParameter("metadata", METADATA_PARAMETER_TYPE, [
+        StructQueryParameter(None, ScalarQueryParameter("key", "STRING", k),
+                             ScalarQueryParameter("value", "STRING", v))
+        for k, v in metadata.items()
+    ])
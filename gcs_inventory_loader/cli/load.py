@@ -16,17 +16,21 @@ Implementation of "catchup" command.
 """
 
 import logging
-from configparser import ConfigParser
-from time import sleep
-from typing import List
+from concurrent.futures import Future
+from typing import Callable, List, Union
 
 from google.cloud.storage import Bucket, Client
 from google.api_core.page_iterator import Page
 
-from gcs_inventory_loader.bq.output import BigQueryOutput
+from gcs_inventory_loader.bq.output import (BigQueryLoadOutput,
+                                            BigQueryOutput, get_output)
 from gcs_inventory_loader.bq.tables import TableDefinitions, get_table
-from gcs_inventory_loader.config import get_config
+from gcs_inventory_loader.cli import load_async
+from gcs_inventory_loader.config import (RuntimeConfig, get_bq_config,
+                                         get_runtime_config)
 from gcs_inventory_loader.gcs.client import get_gcs_client
+from gcs_inventory_loader.gcs.utils import (LIST_PAGE_SIZE, get_buckets,
+                                            listing_options, object_to_row)
 from gcs_inventory_loader.thread import BoundedThreadPoolExecutor
 
 LOG = logging.getLogger(__name__)
@@ -35,116 +39,164 @@ LOG = logging.getLogger(__name__)
 def load_command(buckets: List[str] = None, prefix: str = None) -> None:
     """Implementation of the load command.
 
-    This function dispatches each bucket listed into an executor thread for
-    parallel processing of the bucket list.
+    This function lists the buckets concurrently on an event loop if aiohttp
+    is installed, or otherwise (or if RUNTIME.FORCE_THREADS is set) dispatches
+    each bucket listed into an executor thread for parallel processing of the
+    bucket list.
 
     Keyword Arguments:
         buckets {[str]} -- A list of buckets to use instead of the
         project-wide bucket listing. (default: {None})
         prefix {str} -- A prefix to use when listing. (default: {None})
+
+    Raises:
+        RuntimeError: If any rows could not be written to BigQuery. The
+        errors are logged as they happen.
     """
-    config = get_config()
+    config = get_runtime_config()
     gcs = get_gcs_client()
-    # Call this once to initialize.
-    _ = BigQueryOutput(
+    # One output, shared by all workers, so rows are batched across pages.
+    output = get_output(
         get_table(TableDefinitions.INVENTORY,
-                  config.get("BIGQUERY", "INVENTORY_TABLE")))
+                  get_bq_config().inventory_table))
 
     # if buckets is given, get each bucket object; otherwise, list all bucket
     # objects
     if buckets:
-        buckets = [gcs.get_bucket(x) for x in buckets]
+        buckets = get_buckets(gcs, buckets)
     else:
-        buckets = [x for x in gcs.list_buckets()]
+        buckets = list(gcs.list_buckets())
 
     total_buckets = len(buckets)
     buckets_listed = 0
     bucket_blob_counts = dict()
+    errors = []
 
-    # Use at most 2 workers for this part, as it won't be many
-    workers = min(config.getint('RUNTIME', 'WORKERS'), 2)
-    size = int(config.getint('RUNTIME', 'WORK_QUEUE_SIZE') * .25)
-    with BoundedThreadPoolExecutor(max_workers=workers,
-                                   queue_size=size) as executor:
-        for bucket in buckets:
-            buckets_listed += 1
-            executor.submit(bucket_lister, config, gcs, bucket, prefix,
-                            buckets_listed, total_buckets, bucket_blob_counts)
+    if not config.force_threads and load_async.async_available():
+        projection, fields = listing_options(config)
+        load_async.list_buckets(buckets, prefix, fields, projection,
+                                config.workers, bucket_blob_counts, output,
+                                errors)
+    else:
+        if not config.force_threads:
+            LOG.info("aiohttp is not installed; listing with threads.")
+        # Use at most 2 workers for this part, as it won't be many
+        workers = min(config.workers, 2)
+        size = int(config.work_queue_size * .25)
+        with BoundedThreadPoolExecutor(max_workers=workers,
+                                       queue_size=size) as executor:
+            for bucket in buckets:
+                buckets_listed += 1
+                future = executor.submit(bucket_lister, config, gcs, bucket,
+                                         prefix, buckets_listed,
+                                         total_buckets, bucket_blob_counts,
+                                         output, errors)
+                future.add_done_callback(error_recorder(errors))
 
+    try:
+        output.close()
+    except Exception as error:  # pylint: disable=broad-except
+        LOG.exception("Error flushing rows to BigQuery!")
+        errors.append(error)
+    LOG.info(output.stats())
     LOG.info("Stats: \n\t%s", bucket_blob_counts)
     LOG.info("Total rows: \n\t%s",
-             sum([v for _, v in bucket_blob_counts.items()]))
+             sum(bucket_blob_counts.values()))
+    if errors:
+        raise RuntimeError(
+            "{} errors while loading the inventory; some rows were not "
+            "written. See the log for details.".format(len(errors)))
+
+
+def error_recorder(errors: list) -> Callable[[Future], None]:
+    """Make a future done-callback which logs the future's error, if any,
+    and appends it to a list.
+
+    Arguments:
+        errors {list} -- The list to append errors to.
+
+    Returns:
+        Callable[[Future], None] -- The callback.
+    """
+
+    def record(future: Future) -> None:
+        error = future.exception()
+        if error is not None:
+            LOG.error("Error writing rows to BigQuery!", exc_info=error)
+            errors.append(error)
 
+    return record
 
-def bucket_lister(config: ConfigParser, gcs: Client, bucket: Bucket,
+
+def bucket_lister(config: RuntimeConfig, gcs: Client, bucket: Bucket,
                   prefix: str, bucket_number: int, total_buckets: int,
-                  stats: dict) -> None:
+                  stats: dict,
+                  output: Union[BigQueryOutput, BigQueryLoadOutput],
+                  errors: list) -> None:
     """List a bucket, sending each page of the listing into an executor pool
-    for processing.
+    for processing. Rows are flushed once the whole bucket is processed.
+    Errors writing pages or flushing are logged and appended to errors.
 
     Arguments:
-        config {ConfigParser} -- The program config.
+        config {RuntimeConfig} -- The program runtime config.
         gcs {Client} -- A GCS client object.
         bucket {Bucket} -- A GCS Bucket object to list.
         bucket_number {int} -- The number of this bucket (out of the total).
         total_buckets {int} -- The total number of buckets that will be listed.
         stats {dict} -- A dictionary of bucket_name (str): blob_count (int)
+        output {Union[BigQueryOutput, BigQueryLoadOutput]} -- The output to
+        write rows to.
+        errors {list} -- A list to append errors to.
     """
     LOG.info("Listing %s. %s of %s total buckets", bucket.name, bucket_number,
              total_buckets)
     stats[bucket] = 0
 
-    # Check config to determine whether to retrieve ACL for each blob
-    get_acl = config.getboolean("GCP", "ACLS", fallback=False)
-    projection = ''
-
-    if get_acl is True:
-        projection = 'full'
-    else:
-        projection = 'noAcl'
+    projection, fields = listing_options(config)
 
     # Use remaining configured workers, or at least 2, for this part
-    workers = max(config.getint('RUNTIME', 'WORKERS') - 2, 2)
-    size = int(config.getint('RUNTIME', 'WORK_QUEUE_SIZE') * .75)
+    workers = max(config.workers - 2, 2)
+    size = int(config.work_queue_size * .75)
     with BoundedThreadPoolExecutor(max_workers=workers,
                                    queue_size=size) as sub_executor:
-        blobs = gcs.list_blobs(bucket, prefix=prefix, projection=projection)
+        blobs = gcs.list_blobs(bucket,
+                               prefix=prefix,
+                               projection=projection,
+                               page_size=LIST_PAGE_SIZE,
+                               fields=fields)
+        record = error_recorder(errors)
         for page in blobs.pages:
-            sub_executor.submit(page_outputter, config, bucket, page, stats)
-            sleep(0.02)  # small offset to avoid thundering herd
+            future = sub_executor.submit(page_outputter, config, bucket, page,
+                                         stats, output)
+            future.add_done_callback(record)
+
+    try:
+        output.flush()
+    except Exception as error:  # pylint: disable=broad-except
+        LOG.exception("Error flushing rows to BigQuery!")
+        errors.append(error)
 
 
-def page_outputter(config: ConfigParser, bucket: Bucket, page: Page,
-                   stats: dict) -> None:
+def page_outputter(config: RuntimeConfig, bucket: Bucket, page: Page,
+                   stats: dict,
+                   output: Union[BigQueryOutput, BigQueryLoadOutput]) -> None:
     """Write a page of blob listing to BigQuery.
 
     Arguments:
-        config {ConfigParser} -- The program config.
+        config {RuntimeConfig} -- The program runtime config.
         bucket {Bucket} -- The bucket where this list page came from.
         page {Page} -- The Page object from the listing.
         stats {dict} -- A dictionary of bucket_name (str): blob_count (int)
+        output {Union[BigQueryOutput, BigQueryLoadOutput]} -- The output to
+        write rows to.
     """
-    output = BigQueryOutput(
-        get_table(TableDefinitions.INVENTORY,
-                  config.get("BIGQUERY", "INVENTORY_TABLE")), False)
-    blob_count = 0
-
-    for blob in page:
-        blob_count += 1
-        # pylint: disable=protected-access
-        blob_metadata = blob._properties
-        if "metadata" in blob_metadata:
-            blob_metadata["metadata"] = [{
-                "key": k,
-                "value": v
-            } for k, v in blob_metadata["metadata"].items()]
-        LOG.debug("Outputting blob record {}".format(blob_metadata))
-        output.put(blob_metadata)
-
-    try:
-        output.flush()
-    except Exception:
-        LOG.exception("Error flushing rows to BigQuery!")
-    stats[bucket] += blob_count
+    # pylint: disable=protected-access
+    rows = [object_to_row(blob._properties) for blob in page]
+    if LOG.isEnabledFor(logging.DEBUG):
+        for row in rows:
+            LOG.debug("Outputting blob record %s", row)
+    output.put_many(rows)
+
+    stats[bucket] += len(rows)
     LOG.info("%s blob records written for bucket %s.", stats[bucket],
              bucket.name)
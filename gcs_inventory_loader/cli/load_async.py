@@ -0,0 +1,253 @@
+# Copyright 2019 Google LLC
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+"""
+Bucket listing for the "load" command, on asyncio.
+
+Listing is dominated by HTTP round trips, so rather than a thread per
+concurrent listing, the JSON API is called directly with aiohttp from a
+single event loop. Only handing rows to the output, which may block, is
+done in an executor.
+"""
+
+import asyncio
+import logging
+from concurrent.futures import ThreadPoolExecutor
+from typing import List, Union
+
+import google.auth
+from google.auth.transport.requests import Request
+from google.cloud.storage import Bucket
+
+from gcs_inventory_loader.bq.output import BigQueryLoadOutput, BigQueryOutput
+from gcs_inventory_loader.gcs.utils import LIST_PAGE_SIZE, object_to_row
+from gcs_inventory_loader.utils import json_loads
+
+try:
+    import aiohttp
+except ImportError:
+    aiohttp = None
+
+LOG = logging.getLogger(__name__)
+
+LIST_URL = "https://storage.googleapis.com/storage/v1/b/{}/o"
+SCOPES = ["https://www.googleapis.com/auth/devstorage.read_only"]
+
+# Responses worth retrying, and how many times to try a page in total.
+RETRY_STATUSES = frozenset((408, 429, 500, 502, 503, 504))
+MAX_ATTEMPTS = 5
+
+
+def async_available() -> bool:
+    """Check whether the asyncio lister can be used.
+
+    Returns:
+        bool -- True if aiohttp is installed.
+    """
+    return aiohttp is not None
+
+
+class AuthHeaders():
+    """
+    Authorization headers for the JSON API, from the application default
+    credentials. Tokens are refreshed in an executor, as refreshing blocks.
+    """
+
+    def __init__(self):
+        self.credentials, _ = google.auth.default(scopes=SCOPES)
+        self.lock = asyncio.Lock()
+
+    async def get(self) -> dict:
+        """Get the headers, refreshing the token first if needed.
+
+        Returns:
+            dict -- The headers.
+        """
+        if not self.credentials.valid:
+            async with self.lock:
+                if not self.credentials.valid:
+                    await asyncio.get_event_loop().run_in_executor(
+                        None, self.credentials.refresh, Request())
+        return {"Authorization": "Bearer {}".format(self.credentials.token)}
+
+
+def list_buckets(buckets: List[Bucket], prefix: str, fields: str,
+                 projection: str, concurrency: int, stats: dict,
+                 output: Union[BigQueryOutput, BigQueryLoadOutput],
+                 errors: list) -> None:
+    """List buckets concurrently on an event loop, writing each page of the
+    listings to the output. Returns when all of the buckets are listed.
+
+    Arguments:
+        buckets {List[Bucket]} -- The buckets to list.
+        prefix {str} -- A prefix to use when listing, or None.
+        fields {str} -- The partial response selector for the listing.
+        projection {str} -- The listing projection, "full" or "noAcl".
+        concurrency {int} -- How many pages may be fetched or written at
+        once.
+        stats {dict} -- A dictionary of bucket_name (str): blob_count (int)
+        output {Union[BigQueryOutput, BigQueryLoadOutput]} -- The output to
+        write rows to.
+        errors {list} -- A list to append errors listing buckets to.
+    """
+    # A loop of our own, rather than get_event_loop(), which no longer makes
+    # one when called outside a coroutine.
+    loop = asyncio.new_event_loop()
+    # Executor calls are made holding the page semaphore, so one thread per
+    # permit means they never queue.
+    executor = ThreadPoolExecutor(max_workers=concurrency)
+    loop.set_default_executor(executor)
+    try:
+        loop.run_until_complete(
+            _list_buckets(buckets, prefix, fields, projection, concurrency,
+                          stats, output, errors))
+    finally:
+        loop.close()
+        executor.shutdown()
+
+
+async def _list_buckets(
+        buckets: List[Bucket], prefix: str, fields: str, projection: str,
+        concurrency: int, stats: dict,
+        output: Union[BigQueryOutput, BigQueryLoadOutput],
+        errors: list) -> None:
+    """List buckets concurrently on the running event loop, with one lister
+    per bucket, sharing a single HTTP session and a semaphore with
+    concurrency permits.
+
+    Arguments:
+        buckets {List[Bucket]} -- The buckets to list.
+        prefix {str} -- A prefix to use when listing, or None.
+        fields {str} -- The partial response selector for the listing.
+        projection {str} -- The listing projection, "full" or "noAcl".
+        concurrency {int} -- How many pages may be fetched or written at
+        once.
+        stats {dict} -- A dictionary of bucket_name (str): blob_count (int)
+        output {Union[BigQueryOutput, BigQueryLoadOutput]} -- The output to
+        write rows to.
+        errors {list} -- A list to append errors listing buckets to.
+    """
+    auth = AuthHeaders()
+    semaphore = asyncio.Semaphore(concurrency)
+    params = {
+        "fields": fields,
+        "projection": projection,
+        "maxResults": str(LIST_PAGE_SIZE)
+    }
+    if prefix:
+        params["prefix"] = prefix
+    total_buckets = len(buckets)
+    connector = aiohttp.TCPConnector(limit=concurrency)
+    async with aiohttp.ClientSession(connector=connector) as session:
+        listers = [
+            bucket_lister(session, auth, semaphore, bucket, params,
+                          bucket_number, total_buckets, stats, output, errors)
+            for bucket_number, bucket in enumerate(buckets, 1)
+        ]
+        await asyncio.gather(*listers)
+
+
+async def bucket_lister(
+        session: "aiohttp.ClientSession", auth: AuthHeaders,
+        semaphore: asyncio.Semaphore, bucket: Bucket, params: dict,
+        bucket_number: int, total_buckets: int, stats: dict,
+        output: Union[BigQueryOutput, BigQueryLoadOutput],
+        errors: list) -> None:
+    """List a bucket, writing each page of the listing to the output. Rows
+    are flushed once the whole bucket is processed. Errors are logged and
+    appended to errors rather than raised, so one bucket can't stop the
+    others.
+
+    Arguments:
+        session {aiohttp.ClientSession} -- The HTTP session.
+        auth {AuthHeaders} -- Authorization for the requests.
+        semaphore {asyncio.Semaphore} -- Bounds how many pages are being
+        fetched or written at once, across all buckets.
+        bucket {Bucket} -- A GCS Bucket object to list.
+        params {dict} -- Query parameters for the listing.
+        bucket_number {int} -- The number of this bucket (out of the total).
+        total_buckets {int} -- The total number of buckets that will be listed.
+        stats {dict} -- A dictionary of bucket_name (str): blob_count (int)
+        output {Union[BigQueryOutput, BigQueryLoadOutput]} -- The output to
+        write rows to.
+        errors {list} -- A list to append errors to.
+    """
+    LOG.info("Listing %s. %s of %s total buckets", bucket.name, bucket_number,
+             total_buckets)
+    stats[bucket] = 0
+    loop = asyncio.get_event_loop()
+    url = LIST_URL.format(bucket.name)
+    page_params = dict(params)
+    try:
+        while True:
+            # Hold the permit until the page is written, so that no more
+            # pages are held in memory than there are permits, however many
+            # buckets are waiting on a slow output.
+            async with semaphore:
+                page = await fetch_page(session, auth, url, page_params)
+                rows = [object_to_row(item) for item in page.get("items", ())]
+                if rows:
+                    await loop.run_in_executor(None, output.put_many, rows)
+            stats[bucket] += len(rows)
+            LOG.info("%s blob records written for bucket %s.", stats[bucket],
+                     bucket.name)
+            next_page_token = page.get("nextPageToken")
+            # Drop the page before waiting for another permit.
+            del page, rows
+            if next_page_token is None:
+                break
+            page_params["pageToken"] = next_page_token
+        async with semaphore:
+            await loop.run_in_executor(None, output.flush)
+    except Exception as error:  # pylint: disable=broad-except
+        LOG.exception("Error listing bucket %s!", bucket.name)
+        errors.append(error)
+
+
+async def fetch_page(session: "aiohttp.ClientSession", auth: AuthHeaders,
+                     url: str, params: dict) -> dict:
+    """Fetch one page of an object listing, retrying transient errors with
+    exponential backoff. Transient errors are the statuses in
+    RETRY_STATUSES, connection errors and timeouts.
+
+    Arguments:
+        session {aiohttp.ClientSession} -- The HTTP session.
+        auth {AuthHeaders} -- Authorization for the request.
+        url {str} -- The listing URL for the bucket.
+        params {dict} -- Query parameters, including any page token.
+
+    Raises:
+        aiohttp.ClientResponseError: If the listing fails.
+        aiohttp.ClientError: If the last attempt can't connect.
+        asyncio.TimeoutError: If the last attempt times out.
+
+    Returns:
+        dict -- The decoded response.
+    """
+    for attempt in range(MAX_ATTEMPTS):
+        last_attempt = attempt == MAX_ATTEMPTS - 1
+        try:
+            headers = await auth.get()
+            async with session.get(url, params=params,
+                                   headers=headers) as resp:
+                if resp.status not in RETRY_STATUSES or last_attempt:
+                    resp.raise_for_status()
+                    return json_loads(await resp.read())
+                LOG.debug("Retrying %s after HTTP %s.", url, resp.status)
+        except aiohttp.ClientResponseError:
+            raise
+        except (aiohttp.ClientError, asyncio.TimeoutError) as error:
+            if last_attempt:
+                raise
+            LOG.debug("Retrying %s after %r.", url, error)
+        await asyncio.sleep(2**attempt)
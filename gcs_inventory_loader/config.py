@@ -18,15 +18,60 @@ arguments and config files.
 
 import io
 from configparser import ConfigParser
+from typing import Callable, NamedTuple
+
+
+class RuntimeConfig(NamedTuple):
+    """
+    Snapshot of the GCP and RUNTIME settings used while listing, with
+    defaults applied.
+    """
+    gcs_project: str
+    acls: bool
+    workers: int
+    work_queue_size: int
+    force_threads: bool
+
+
+class BigQueryConfig(NamedTuple):
+    """
+    Snapshot of the BIGQUERY section of the configuration, with defaults
+    applied.
+    """
+    job_project: str
+    dataset_name: str
+    inventory_table: str
+    catchup_table: str
+    batch_write_size: int
+    max_write_bytes: int
+    max_pending_batches: int
+    use_load_jobs: bool
+    load_job_rows: int
+    load_job_bytes: int
+
+
+class RulesConfig(NamedTuple):
+    """
+    Snapshot of the RULES section of the configuration.
+    """
+    cold_threshold_days: int
+    warm_threshold_days: int
+    warm_threshold_accesses: int
+    days_between_runs: int
 
 
 class ConfigParserHolder():
     """
-    Object to hold the configuration in this module.
+    Object to hold the configuration in this module, and the caches which
+    depend on it.
     """
 
     def __init__(self):
         self.config = None
+        self.runtime = None
+        self.bigquery = None
+        self.rules = None
+        self.caches = []
 
 
 CONFIG_HOLDER = ConfigParserHolder()
@@ -46,6 +91,58 @@ def set_config(config_file: str) -> ConfigParser:
     config.read(config_file)
     check_configured(config)
     CONFIG_HOLDER.config = config
+    CONFIG_HOLDER.runtime = RuntimeConfig(
+        gcs_project=config.get('GCP',
+                               'GCS_PROJECT',
+                               fallback=config.get('GCP',
+                                                   'PROJECT',
+                                                   fallback=None)),
+        acls=config.getboolean('GCP', 'ACLS', fallback=False),
+        workers=config.getint('RUNTIME', 'WORKERS', fallback=64),
+        work_queue_size=config.getint('RUNTIME',
+                                      'WORK_QUEUE_SIZE',
+                                      fallback=1000),
+        force_threads=config.getboolean('RUNTIME',
+                                        'FORCE_THREADS',
+                                        fallback=False))
+    CONFIG_HOLDER.bigquery = BigQueryConfig(
+        job_project=config.get('BIGQUERY',
+                               'JOB_PROJECT',
+                               fallback=config.get('GCP',
+                                                   'PROJECT',
+                                                   fallback=None)),
+        dataset_name=config.get('BIGQUERY', 'DATASET_NAME', fallback=None),
+        inventory_table=config.get('BIGQUERY',
+                                   'INVENTORY_TABLE',
+                                   fallback=None),
+        catchup_table=config.get('BIGQUERY', 'CATCHUP_TABLE', fallback=None),
+        batch_write_size=config.getint('BIGQUERY',
+                                       'BATCH_WRITE_SIZE',
+                                       fallback=500),
+        max_write_bytes=config.getint('BIGQUERY',
+                                      'MAX_WRITE_BYTES',
+                                      fallback=9000000),
+        max_pending_batches=config.getint('BIGQUERY',
+                                          'MAX_PENDING_BATCHES',
+                                          fallback=8),
+        use_load_jobs=config.getboolean('BIGQUERY',
+                                        'USE_LOAD_JOBS',
+                                        fallback=False),
+        load_job_rows=config.getint('BIGQUERY',
+                                    'LOAD_JOB_ROWS',
+                                    fallback=1000000),
+        load_job_bytes=config.getint('BIGQUERY',
+                                     'LOAD_JOB_BYTES',
+                                     fallback=100 * 1024 * 1024))
+    CONFIG_HOLDER.rules = None
+    if config.has_section('RULES'):
+        CONFIG_HOLDER.rules = RulesConfig(
+            cold_threshold_days=config.getint('RULES', 'COLD_THRESHOLD_DAYS'),
+            warm_threshold_days=config.getint('RULES', 'WARM_THRESHOLD_DAYS'),
+            warm_threshold_accesses=config.getint('RULES',
+                                                  'WARM_THRESHOLD_ACCESSES'),
+            days_between_runs=config.getint('RULES', 'DAYS_BETWEEN_RUNS'))
+    invalidate_caches()
     return CONFIG_HOLDER.config
 
 
@@ -59,6 +156,60 @@ def get_config() -> ConfigParser:
     return CONFIG_HOLDER.config
 
 
+def get_runtime_config() -> RuntimeConfig:
+    """Get the snapshot of the GCP and RUNTIME settings used while listing.
+
+    Returns:
+        RuntimeConfig -- The GCP and RUNTIME values.
+    """
+    return CONFIG_HOLDER.runtime
+
+
+def get_bq_config() -> BigQueryConfig:
+    """Get the snapshot of the BIGQUERY section of the configuration.
+
+    Returns:
+        BigQueryConfig -- The BIGQUERY values.
+    """
+    return CONFIG_HOLDER.bigquery
+
+
+def get_rules() -> RulesConfig:
+    """Get the snapshot of the RULES section of the configuration.
+
+    Returns:
+        RulesConfig -- The RULES values.
+
+    Raises:
+        ValueError -- If the configuration has no RULES section.
+    """
+    if CONFIG_HOLDER.rules is None:
+        raise ValueError("No RULES section in configuration.")
+    return CONFIG_HOLDER.rules
+
+
+def register_cache(cached_function: Callable) -> Callable:
+    """Register a functools.lru_cache wrapped function whose results depend
+    on the configuration, so its cache is cleared whenever the configuration
+    is set. Can be used as a decorator.
+
+    Arguments:
+        cached_function {Callable} -- The lru_cache wrapped function.
+
+    Returns:
+        Callable -- The same function.
+    """
+    CONFIG_HOLDER.caches.append(cached_function)
+    return cached_function
+
+
+def invalidate_caches() -> None:
+    """Clear the caches of all functions registered with register_cache.
+    """
+    for cached_function in CONFIG_HOLDER.caches:
+        cached_function.cache_clear()
+
+
 def config_to_string(config: ConfigParser) -> str:
     """ConfigParser seems to only do nice formatting when writing
     to a file pointer. This function turns that output into a string.
@@ -16,11 +16,12 @@ Module containing GCS code for this program.
 """
 
 import logging
+from itertools import count
 from threading import Lock
 
 from google.cloud import storage
 
-from gcs_inventory_loader.config import get_config
+from gcs_inventory_loader.config import get_runtime_config
 
 LOG = logging.getLogger(__name__)
 
@@ -33,31 +34,27 @@ class GCSClientPool():
     def __init__(self, size=32):
         self.clients = []
         self.pool_size = size
-        self.next_up = 0
+        self.counter = count()
         self.lock = Lock()
 
     def get_client(self) -> storage.client:
-        """Get a client from the pool. Automatically makes new ones until
-        the pool is full. Threadsafe.
+        """Get a client from the pool. The pool is filled on first use;
+        after that, no lock is taken, as next() on the counter is atomic.
+        Threadsafe.
 
         Returns:
             storage.client -- A configured GCS client.
         """
-        config = get_config()
-        self.lock.acquire()
-        if len(self.clients) < self.pool_size:
-            LOG.debug("Making new GCS client.")
-            self.clients.append(
-                storage.Client(
-                    config.get('GCP',
-                               'GCS_PROJECT',
-                               fallback=config.get('GCP', 'PROJECT'))))
-        client = self.clients[self.next_up]
-        self.next_up += 1
-        if self.next_up >= self.pool_size - 1:
-            self.next_up = 0
-        self.lock.release()
-        return client
+        if not self.clients:
+            with self.lock:
+                if not self.clients:
+                    LOG.debug("Making %s new GCS clients.", self.pool_size)
+                    project = get_runtime_config().gcs_project
+                    self.clients = [
+                        storage.Client(project)
+                        for _ in range(self.pool_size)
+                    ]
+        return self.clients[next(self.counter) % self.pool_size]
 
 
 CLIENTS = GCSClientPool()
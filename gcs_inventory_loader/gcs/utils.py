@@ -15,6 +15,20 @@
 Module containing some GCS utility functions.
 """
 
+from concurrent.futures import ThreadPoolExecutor
+from typing import Iterable, List, Tuple
+
+from google.cloud.storage import Bucket, Client
+
+from gcs_inventory_loader.bq.tables import TableDefinitions
+from gcs_inventory_loader.config import RuntimeConfig
+
+# Objects per page when listing a bucket. This is the most the API allows.
+LIST_PAGE_SIZE = 1000
+
+# Most buckets to fetch at once when looking up buckets by name.
+MAX_BUCKET_FETCHES = 16
+
 # This is a mapping of storage classes understood by this program to storage
 # classes which may be encountered when describing blobs. In general,
 # the blob API will use more verbose names, or a handful of legacy names.
@@ -24,14 +38,18 @@ Module containing some GCS utility functions.
 # The storage class names used by this program are also included in the
 # mapping, so this can be used with storage class descriptions from other
 # sources, like the catchup table.
+# Keys and values are upper case, and values are sets for fast membership
+# tests.
 STORAGE_CLASS_MAPPING = {
-    'STANDARD': [
-        'STANDARD', 'STANDARD_STORAGE_CLASS', 'REGIONAL_LEGACY_STORAGE_CLASS',
-        'MULTI_REGIONAL_LEGACY_STORAGE_CLASS',
-        'DURABLE_REDUCED_AVAILABILITY_STORAGE_CLASS'
-    ],
-    'NEARLINE': ['NEARLINE', 'NEARLINE_STORAGE_CLASS'],
-    'COLDLINE': ['COLDLINE', 'COLDLINE_STORAGE_CLASS']
+    'STANDARD':
+    frozenset(('STANDARD', 'STANDARD_STORAGE_CLASS',
+               'REGIONAL_LEGACY_STORAGE_CLASS',
+               'MULTI_REGIONAL_LEGACY_STORAGE_CLASS',
+               'DURABLE_REDUCED_AVAILABILITY_STORAGE_CLASS')),
+    'NEARLINE':
+    frozenset(('NEARLINE', 'NEARLINE_STORAGE_CLASS')),
+    'COLDLINE':
+    frozenset(('COLDLINE', 'COLDLINE_STORAGE_CLASS'))
 }
 
 
@@ -48,6 +66,97 @@ def check_redundant_rewrite(destination_class: str,
     Returns:
         bool -- True if the write is redundant.
     """
-    destination_class = destination_class.upper()
-    origination_class = origination_class.upper()
-    return origination_class in STORAGE_CLASS_MAPPING[destination_class]
+    return origination_class.upper() in STORAGE_CLASS_MAPPING[
+        destination_class.upper()]
+
+
+def get_buckets(gcs: Client, bucket_names: List[str]) -> List[Bucket]:
+    """Fetch buckets by name, several at a time.
+
+    Arguments:
+        gcs {Client} -- A GCS client object.
+        bucket_names {List[str]} -- The names of the buckets.
+
+    Raises:
+        google.api_core.exceptions.NotFound: If a bucket doesn't exist.
+
+    Returns:
+        List[Bucket] -- The buckets, in the order they were named.
+    """
+    workers = max(min(len(bucket_names), MAX_BUCKET_FETCHES), 1)
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        return list(executor.map(gcs.get_bucket, bucket_names))
+
+
+def list_fields_selector(field_names: Iterable[str]) -> str:
+    """Build a partial response selector for an object listing, so that only
+    the given object fields are sent.
+
+    Arguments:
+        field_names {Iterable[str]} -- The object resource fields to include.
+
+    Returns:
+        str -- The selector, for the fields argument of list_blobs.
+    """
+    return "items({}),nextPageToken".format(",".join(field_names))
+
+
+def listing_options(config: RuntimeConfig) -> Tuple[str, str]:
+    """Get the projection and partial response selector to list objects
+    with.
+
+    Arguments:
+        config {RuntimeConfig} -- The program runtime config.
+
+    Returns:
+        Tuple[str, str] -- The projection, and the fields selector.
+    """
+    # Check config to determine whether to retrieve ACL for each blob
+    get_acl = config.acls
+    projection = ''
+
+    if get_acl is True:
+        projection = 'full'
+    else:
+        projection = 'noAcl'
+
+    # Only ask for the fields the inventory table has.
+    fields = list_fields_selector(
+        x.name for x in TableDefinitions.INVENTORY.value["schema"]
+        if get_acl or x.name != "acl")
+    return projection, fields
+
+
+def metadata_to_structs(metadata: dict) -> List[dict]:
+    """Convert object custom metadata to the list of key/value structs which
+    the inventory table stores.
+
+    The structs are built fresh for every object, as rows are held in
+    output buffers until they are sent, so they can't share storage. The
+    inventory table's metadata column is a repeated record, so the structs
+    can't be replaced by a serialized string without changing its schema.
+
+    Arguments:
+        metadata {dict} -- The custom metadata.
+
+    Returns:
+        List[dict] -- The metadata as {"key": ..., "value": ...} dicts.
+    """
+    return [{"key": k, "value": v} for k, v in metadata.items()]
+
+
+def object_to_row(properties: dict) -> dict:
+    """Build an inventory row from an object resource. The resource itself is
+    not modified; if it has custom metadata, a shallow copy is returned with
+    the metadata converted by metadata_to_structs.
+
+    Arguments:
+        properties {dict} -- The object resource, such as Blob._properties.
+
+    Returns:
+        dict -- The row.
+    """
+    metadata = properties.get("metadata")
+    if metadata is None:
+        return properties
+    return {**properties, "metadata": metadata_to_structs(metadata)}
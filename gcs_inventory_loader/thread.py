@@ -15,21 +15,45 @@
 Custom threading code.
 """
 
-from concurrent.futures import ThreadPoolExecutor
-from queue import Queue
+from concurrent.futures import Future, ThreadPoolExecutor
+from threading import BoundedSemaphore
 
 
 class BoundedThreadPoolExecutor(ThreadPoolExecutor):
-    """A wrapper around concurrent.futures.thread.py to add a bounded
-    queue to ThreadPoolExecutor.
+    """A wrapper around concurrent.futures.thread.py to bound the amount of
+    work waiting in ThreadPoolExecutor.
     """
 
     def __init__(self, *args, queue_size: int = 1000, **kwargs):
-        """Construct a slightly modified ThreadPoolExecutor with a
-        bounded queue for work. Causes submit() to block when full.
+        """Construct a slightly modified ThreadPoolExecutor which holds at
+        most queue_size waiting work items. Causes submit() to block when
+        full.
 
-        Arguments:
-            ThreadPoolExecutor {[type]} -- [description]
+        The bound is enforced with a semaphore around submit(), released as
+        each work item finishes, rather than by replacing the executor's
+        work queue with a bounded Queue.
+
+        Keyword Arguments:
+            queue_size {int} -- How many work items may wait for a worker.
+            (default: {1000})
         """
         super().__init__(*args, **kwargs)
-        self._work_queue = Queue(queue_size)
+        self._slots = BoundedSemaphore(queue_size + self._max_workers)
+
+    def submit(self, fn, *args, **kwargs) -> Future:
+        """Submit a callable for execution, blocking until there is room.
+
+        Arguments:
+            fn {callable} -- The callable to execute.
+
+        Returns:
+            Future -- A future representing the execution of the callable.
+        """
+        self._slots.acquire()
+        try:
+            future = super().submit(fn, *args, **kwargs)
+        except BaseException:
+            self._slots.release()
+            raise
+        future.add_done_callback(lambda _: self._slots.release())
+        return future
@@ -15,12 +15,55 @@
 Utility functions not specific to any submodule.
 """
 
+import json
 import logging
 import sys
 from configparser import ConfigParser
 
 from gcs_inventory_loader.constants import PROGRAM_ROOT_LOGGER_NAME
 
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+# Fallback encoder, built once, for when orjson is not installed.
+JSON_ENCODER = json.JSONEncoder(separators=(",", ":"),
+                                ensure_ascii=False,
+                                default=str)
+
+
+def json_dumps(obj) -> bytes:
+    """Serialize an object to compact JSON. Uses orjson if it is installed,
+    or a shared stdlib encoder otherwise. Values JSON can't represent are
+    serialized with str().
+
+    Arguments:
+        obj {object} -- The object to serialize.
+
+    Returns:
+        bytes -- The JSON, encoded as UTF-8.
+    """
+    if orjson:
+        return orjson.dumps(obj, default=str)  # pylint: disable=no-member
+    return JSON_ENCODER.encode(obj).encode("utf-8")
+
+
+def json_loads(data: bytes) -> object:
+    """Deserialize JSON. Uses orjson if it is installed, or the stdlib
+    otherwise. Either way, UTF-8 bytes are read directly, without decoding
+    to a str first.
+
+    Arguments:
+        data {bytes} -- The JSON.
+
+    Returns:
+        object -- The deserialized object.
+    """
+    if orjson:
+        return orjson.loads(data)  # pylint: disable=no-member
+    return json.loads(data)
+
 
 def validate_log_level(level: str) -> bool:
     """Test whether a log level is valid.
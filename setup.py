@@ -47,7 +47,11 @@ setup(
         'google-cloud-storage',
         'google-cloud-pubsub',
         'click',
+        'orjson',
     ],
+    extras_require={
+        'async': ['aiohttp'],
+    },
     entry_points={
         'console_scripts': [
             'gcs_inventory = gcs_inventory_loader:main',
@@ -0,0 +1,42 @@
+# Copyright 2019 Google LLC
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+"""
+Tests for the BigQuery utility functions.
+"""
+
+import pytest
+
+from gcs_inventory_loader.bq.utils import get_bucket_and_object
+
+
+def test_get_bucket_and_object():
+    assert get_bucket_and_object(
+        "projects/_/buckets/bucket/objects/path/to/object") == (
+            "bucket", "path/to/object")
+
+
+def test_get_bucket_and_object_of_a_folder():
+    assert get_bucket_and_object(
+        "projects/_/buckets/bucket/objects/folder/") == ("bucket", None)
+
+
+@pytest.mark.parametrize("resource_name", [
+    "garbage",
+    "projects/_/buckets/bucket",
+    "projects/_/buckets/bucket/",
+    "projects/_/objects/object",
+])
+def test_get_bucket_and_object_rejects_malformed_names(resource_name):
+    with pytest.raises(ValueError):
+        get_bucket_and_object(resource_name)
@@ -0,0 +1,73 @@
+# Copyright 2019 Google LLC
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+"""
+Tests for the load command.
+"""
+
+from unittest import mock
+
+import pytest
+
+from gcs_inventory_loader import config
+from gcs_inventory_loader.cli import load
+
+CONFIG = """
+[GCP]
+PROJECT=project
+[RUNTIME]
+WORKERS=4
+WORK_QUEUE_SIZE=8
+FORCE_THREADS=yes
+[BIGQUERY]
+DATASET_NAME=dataset
+INVENTORY_TABLE=inventory
+"""
+
+
+def run_load(tmp_path, output):
+    config_file = tmp_path / "test.cfg"
+    config_file.write_text(CONFIG)
+    config.set_config(str(config_file))
+    bucket = mock.Mock()
+    bucket.name = "bucket"
+    blob = mock.Mock(_properties={"name": "object"})
+    gcs = mock.Mock()
+    gcs.list_buckets.return_value = [bucket]
+    gcs.list_blobs.return_value.pages = [[blob], [blob]]
+    with mock.patch.object(load, "get_gcs_client", return_value=gcs), \
+            mock.patch.object(load, "get_table"), \
+            mock.patch.object(load, "get_output", return_value=output):
+        load.load_command()
+
+
+def test_load_succeeds(tmp_path):
+    output = mock.Mock()
+    run_load(tmp_path, output)
+    assert output.put_many.call_count == 2
+    output.close.assert_called_once_with()
+
+
+def test_load_raises_when_writing_a_page_fails(tmp_path):
+    output = mock.Mock()
+    output.put_many.side_effect = [None, ValueError("load job failed")]
+    with pytest.raises(RuntimeError):
+        run_load(tmp_path, output)
+    output.close.assert_called_once_with()
+
+
+def test_load_raises_when_closing_the_output_fails(tmp_path):
+    output = mock.Mock()
+    output.close.side_effect = ValueError("load job failed")
+    with pytest.raises(RuntimeError):
+        run_load(tmp_path, output)
@@ -0,0 +1,84 @@
+# Copyright 2019 Google LLC
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+"""
+Tests for the asyncio bucket lister.
+"""
+
+import time
+from threading import Lock
+from unittest import mock
+
+import pytest
+
+from gcs_inventory_loader.cli import load_async
+
+pytestmark = pytest.mark.skipif(not load_async.async_available(),
+                                reason="aiohttp is not installed")
+
+PAGES_PER_BUCKET = 3
+
+
+class SlowOutput():
+    """
+    An output which takes a while to accept rows, and counts how many
+    fetched pages are waiting to be written at once.
+    """
+
+    def __init__(self):
+        self.lock = Lock()
+        self.pending = 0
+        self.max_pending = 0
+        self.rows = 0
+
+    def fetched(self) -> None:
+        with self.lock:
+            self.pending += 1
+            self.max_pending = max(self.max_pending, self.pending)
+
+    def put_many(self, rows) -> None:
+        time.sleep(0.01)
+        with self.lock:
+            self.pending -= 1
+            self.rows += len(rows)
+
+    def flush(self) -> None:
+        pass
+
+
+def test_pages_in_memory_are_bounded_by_concurrency():
+    output = SlowOutput()
+
+    async def fetch_page(session, auth, url, params):
+        # pylint: disable=unused-argument
+        output.fetched()
+        page = int(params.get("pageToken", 0)) + 1
+        result = {"items": [{"name": "object"}]}
+        if page < PAGES_PER_BUCKET:
+            result["nextPageToken"] = str(page)
+        return result
+
+    buckets = []
+    for number in range(20):
+        bucket = mock.Mock()
+        bucket.name = "bucket{}".format(number)
+        buckets.append(bucket)
+    errors = []
+    with mock.patch.object(load_async, "fetch_page", fetch_page), \
+            mock.patch.object(load_async, "AuthHeaders"):
+        load_async.list_buckets(buckets, None, "items(name)", "noAcl", 2,
+                                dict(), output, errors)
+
+    assert not errors
+    assert output.rows == 20 * PAGES_PER_BUCKET
+    assert output.max_pending <= 2
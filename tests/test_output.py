@@ -0,0 +1,166 @@
+# Copyright 2019 Google LLC
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+"""
+Tests for the BigQuery outputs.
+"""
+
+import gzip
+import json
+from unittest import mock
+
+import pytest
+import requests
+from google.api_core import exceptions
+from google.auth.credentials import AnonymousCredentials
+from google.cloud import bigquery
+
+from gcs_inventory_loader import config
+from gcs_inventory_loader.bq import output
+
+CONFIG = """
+[GCP]
+PROJECT=project
+[BIGQUERY]
+DATASET_NAME=dataset
+INVENTORY_TABLE=inventory
+BATCH_WRITE_SIZE=10
+USE_LOAD_JOBS={use_load_jobs}
+"""
+
+JOB_RESOURCE = {
+    "jobReference": {
+        "projectId": "project",
+        "jobId": "job"
+    },
+    "configuration": {
+        "load": {}
+    },
+    "status": {
+        "state": "DONE"
+    }
+}
+
+
+class FakeTransport(requests.Session):
+    """
+    An HTTP transport for a real BigQuery client, which records requests and
+    answers every one as if it created a finished job.
+    """
+    is_mtls = False
+
+    def __init__(self):
+        super().__init__()
+        self.requests = []
+
+    def request(self, method, url, data=None, headers=None, **kwargs):
+        # pylint: disable=arguments-differ
+        self.requests.append((method, url, data))
+        response = requests.Response()
+        response.status_code = 200
+        response.headers["content-type"] = "application/json"
+        if method == "POST" and "uploadType=resumable" in url:
+            response.headers["location"] = "https://upload.example/session"
+        response._content = json.dumps(JOB_RESOURCE).encode()
+        response.request = requests.Request(method, url).prepare()
+        return response
+
+
+class FakeTable():
+    """
+    A Table which is never initialized.
+    """
+
+    @staticmethod
+    def get_fully_qualified_name() -> str:
+        return "project.dataset.inventory"
+
+
+def make_output(tmp_path, client, use_load_jobs=False):
+    config_file = tmp_path / "test.cfg"
+    config_file.write_text(CONFIG.format(use_load_jobs=use_load_jobs))
+    config.set_config(str(config_file))
+    with mock.patch.object(output, "get_bq_client", return_value=client):
+        return output.get_output(FakeTable(), create_table=False)
+
+
+def test_load_job_uploads_staged_rows(tmp_path):
+    transport = FakeTransport()
+    client = bigquery.Client(project="project",
+                             credentials=AnonymousCredentials(),
+                             _http=transport)
+    out = make_output(tmp_path, client, use_load_jobs=True)
+
+    out.put({"name": "a"})
+    out.close()
+
+    uploaded = b"".join(data for method, _, data in transport.requests
+                        if method == "PUT")
+    assert gzip.decompress(uploaded) == b'{"name":"a"}\n'
+    assert out.insert_count == 1
+
+
+class RejectingClient():
+    """
+    A BigQuery client which rejects streaming inserts of more than
+    max_rows rows with the given error.
+    """
+
+    def __init__(self, max_rows, status, message):
+        self.max_rows = max_rows
+        self.status = status
+        self.message = message
+        self.inserted = []
+
+    def insert_rows_json(self, table, rows):
+        # pylint: disable=unused-argument
+        if len(rows) > self.max_rows:
+            raise exceptions.from_http_status(self.status, self.message)
+        self.inserted.extend(rows)
+        return []
+
+
+@pytest.mark.parametrize("status, message", [
+    (413, "Request Entity Too Large"),
+    (400, "Request payload size exceeds the limit: 10485760 bytes."),
+])
+def test_rejected_insert_is_split_and_batch_size_settles(
+        tmp_path, status, message):
+    client = RejectingClient(4, status, message)
+    out = make_output(tmp_path, client)
+
+    for i in range(100):
+        out.put({"i": i})
+    out.close()
+
+    assert sorted(row["i"] for row in client.inserted) == list(range(100))
+    assert out.batch_size_ceiling <= 4
+    assert out.dynamic_batch_size <= 4
+
+
+def test_rate_limited_insert_is_retried_whole(tmp_path):
+    client = mock.Mock()
+    client.insert_rows_json.side_effect = [
+        exceptions.TooManyRequests("slow down"), []
+    ]
+    out = make_output(tmp_path, client)
+
+    with mock.patch.object(output, "sleep") as sleep:
+        for i in range(10):
+            out.put({"i": i})
+        out.close()
+
+    sleep.assert_called_once_with(output.RATE_LIMIT_BACKOFF)
+    assert [len(call[0][1]) for call in client.insert_rows_json.call_args_list
+            ] == [10, 10]
+    assert out.dynamic_batch_size == 10